@@ -0,0 +1,203 @@
+import argparse
+import os
+import os.path
+import glob
+import time
+import hashlib
+import multiprocessing
+import concurrent.futures
+
+from crocodl.runtime.image_store import ImageStore
+from crocodl.runtime.http_utils import StatusServer, set_status
+from crocodl.image.search.search_tool import SearchTool
+
+# in each worker process, the number of images loaded by each worker (shared with the parent)
+worker_counts = None
+
+def init_worker(counts,tf_threads):
+    # runs in each (freshly spawned) worker process before any model is created
+    global worker_counts
+    worker_counts = counts
+    if tf_threads:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(tf_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+class WorkerSearchTool(SearchTool):
+
+    def __init__(self,worker,*args,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.worker = worker
+
+    def process_batch(self,batch):
+        loaded_count = self.loaded_count
+        stored = super().process_batch(batch)
+        with worker_counts.get_lock():
+            worker_counts[self.worker] += self.loaded_count - loaded_count
+        return stored
+
+def index_files(worker,db_path,folder,filepaths,architecture,settings):
+    # runs in a worker process: load filepaths into the worker's own store, which already holds any files
+    # loaded by an interrupted run, these are skipped
+    tool = WorkerSearchTool(worker,architecture,db_path,**settings)
+    tool.open()
+    tool.load_images(folder,filepaths)
+    return (tool.loaded_count,tool.skipped_count)
+
+class BulkIndexer(object):
+    """
+    Load a large folder of images into an image store using several worker processes, each with its own model.
+
+    The folder's files are divided between the workers by a hash of their path.  Each worker loads its files
+    into a worker store in <db_path>.bulk/ and the worker stores are then merged into the image store and
+    removed.  If indexing is interrupted, running it again skips the files that the workers (or the image
+    store) already hold, so only the remaining files are embedded.
+    """
+
+    def __init__(self,architecture,db_path,workers=4,tf_threads=1,batch_size=32,decode_workers=2,queue_depth=64,
+                 shards=1,precision=None,indexes=None,pca_dimension=0,pca_whiten=False,embedding_cache_path=None,
+                 embedding_cache_size_mb=1024,report_interval=10):
+        self.db_path = db_path
+        self.workers = workers
+        self.tf_threads = tf_threads
+        self.report_interval = report_interval
+        self.tool = SearchTool(architecture,db_path,indexes=indexes,pca_dimension=pca_dimension,pca_whiten=pca_whiten,
+                               shards=shards,precision=precision)
+        self.worker_settings = {"batch_size":batch_size, "decode_workers":decode_workers, "queue_depth":queue_depth,
+                                "embedding_cache_path":embedding_cache_path,
+                                "embedding_cache_size_mb":embedding_cache_size_mb}
+
+    def get_work_folder(self):
+        return self.db_path + ".bulk"
+
+    def get_worker_db_path(self,worker):
+        return os.path.join(self.get_work_folder(),"worker-%d.db"%(worker))
+
+    def list_files(self,folder):
+        # divide the files in folder between the workers, leaving out any already in the image store unchanged
+        file_info = self.tool.imagestore.getFileInfo()
+        tags_path = os.path.join(folder, SearchTool.TAGS_FILENAME)
+        assignments = [[] for worker in range(self.workers)]
+        skipped_count = 0
+        for filepath in glob.iglob(folder + '/**', recursive=True):
+            if not os.path.isfile(filepath) or filepath == tags_path:
+                continue
+            relpath = os.path.relpath(filepath, start=folder)
+            known = file_info.get(relpath, None)
+            if known:
+                stat = os.stat(filepath)
+                if known[1] == stat.st_size and known[2] == stat.st_mtime:
+                    skipped_count += 1
+                    continue
+            digest = hashlib.md5(relpath.encode("utf-8")).hexdigest()
+            assignments[int(digest[:8],16) % self.workers].append(filepath)
+        return (assignments, skipped_count)
+
+    def report(self,status,loaded_count,elapsed):
+        rate = loaded_count / elapsed if elapsed > 0 else 0.0
+        print("%s: %d images in %.0f seconds (%.1f images/sec)"%(status,loaded_count,elapsed,rate))
+        set_status({"status":status, "latest_image_path":"", "latest_image_uri":"",
+                    "database_size":len(self.tool.imagestore),
+                    "timings":{"elapsed_seconds":elapsed, "images_per_second":rate}})
+
+    def run(self,folder):
+        self.tool.open_store()
+        os.makedirs(self.get_work_folder(), exist_ok=True)
+        (assignments, skipped_count) = self.list_files(folder)
+        # files already loaded into a worker store by an interrupted run are skipped by the worker
+        print("Dividing %d images between %d workers (%d unchanged in the store)"%(sum(map(len,assignments)),
+                                                                                   self.workers,skipped_count))
+
+        start = time.time()
+        counts = multiprocessing.get_context("spawn").Array("q",self.workers)
+        with concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                                    initializer=init_worker,
+                                                    initargs=(counts,self.tf_threads)) as executor:
+            futures = [executor.submit(index_files,worker,self.get_worker_db_path(worker),folder,filepaths,
+                                       self.tool.architecture,self.worker_settings)
+                       for (worker,filepaths) in enumerate(assignments) if filepaths]
+            while True:
+                (done, pending) = concurrent.futures.wait(futures, timeout=self.report_interval)
+                if not pending:
+                    break
+                self.report("Embedding", sum(counts), time.time() - start)
+            for future in done:
+                # raise any exception from the workers
+                future.result()
+        loaded_count = sum(counts)
+        self.report("Embedded", loaded_count, time.time() - start)
+
+        self.merge()
+        tags_path = os.path.join(folder, SearchTool.TAGS_FILENAME)
+        if os.path.isfile(tags_path):
+            self.tool.imagestore.setTags(self.tool.read_tags(tags_path))
+        if self.tool.pca_dimension and not self.tool.imagestore.isEmpty() and self.tool.imagestore.getProjection() is None:
+            self.tool.imagestore.fitProjection(self.tool.pca_dimension,self.tool.pca_whiten)
+        self.report("Indexed", loaded_count, time.time() - start)
+
+    def merge(self):
+        # copy each worker store into the image store, removing the worker store once it has been copied
+        # (a worker store that was partially copied before an interruption is simply copied again)
+        store = self.tool.imagestore
+        worker_paths = sorted(glob.glob(os.path.join(self.get_work_folder(),"worker-*.db")))
+        store.open()
+        for worker_path in worker_paths:
+            worker_store = ImageStore(worker_path)
+            if worker_store.getArchitecture() == self.tool.architecture:
+                for entries in worker_store.exportEmbeddings():
+                    store.addEmbeddings(entries)
+            ImageStore.delete(worker_path)
+        store.close()
+        os.rmdir(self.get_work_folder())
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", help="specify the path to the image database",
+                        type=str, default="/tmp/image.db", metavar="<DB-PATH>")
+    parser.add_argument("--image_folder", help="specify the folder with images to load into the database",
+                        type=str, default="", metavar="<IMAGE-FOLDER>")
+    parser.add_argument("--architecture", help="the architecture of the model",
+                        type=str, default="", metavar="<ARCHITECTURE>")
+    parser.add_argument("--workers", help="number of worker processes, each loading its own model",
+                        type=int, default=4, metavar="<WORKERS>")
+    parser.add_argument("--tf_threads", help="number of threads used by each worker's model (0 - tensorflow's default)",
+                        type=int, default=1, metavar="<TF-THREADS>")
+    parser.add_argument("--batch_size", help="number of images to embed in each forward pass",
+                        type=int, default=32, metavar="<BATCH-SIZE>")
+    parser.add_argument("--decode_workers", help="number of threads decoding and resizing images in each worker",
+                        type=int, default=2, metavar="<DECODE-WORKERS>")
+    parser.add_argument("--queue_depth", help="maximum number of decoded images waiting to be embedded in each worker",
+                        type=int, default=64, metavar="<QUEUE-DEPTH>")
+    parser.add_argument("--shards", help="when creating a new store, split it across this many shard databases",
+                        type=int, default=1, metavar="<SHARDS>")
+    parser.add_argument("--precision", help="precision of the embeddings scanned by searches (float32, float16 or int8)",
+                        type=str, default="", metavar="<PRECISION>")
+    parser.add_argument("--indexes", help="comma separated list of indexes to maintain (ivf,pq,binary,coarse), or none",
+                        type=str, default="", metavar="<INDEXES>")
+    parser.add_argument("--pca_dimension", help="once images are loaded, reduce stored embeddings to this dimension using PCA",
+                        type=int, default=0, metavar="<PCA-DIMENSION>")
+    parser.add_argument("--pca_whiten", help="whiten the PCA projection", action="store_true")
+    parser.add_argument("--embedding_cache", help="path to a cache of embeddings shared between stores and load jobs",
+                        type=str, default="", metavar="<EMBEDDING-CACHE>")
+    parser.add_argument("--embedding_cache_size_mb", help="maximum size of the embedding cache in MB",
+                        type=int, default=1024, metavar="<EMBEDDING-CACHE-SIZE-MB>")
+    parser.add_argument("--report_interval", help="seconds between progress reports",
+                        type=int, default=10, metavar="<REPORT-INTERVAL>")
+    parser.add_argument("--tracker_port", help="port for services",
+                        type=int, default=9099, metavar="<TRACKER-PORT>")
+
+    args = parser.parse_args()
+    if args.tracker_port > -1:
+        st = StatusServer(args.tracker_port)
+        st.start()
+    indexes = None
+    if args.indexes:
+        indexes = {name:None for name in args.indexes.split(",") if name in ImageStore.INDEX_CLASSES}
+    indexer = BulkIndexer(args.architecture,args.db_path,workers=args.workers,tf_threads=args.tf_threads,
+                          batch_size=args.batch_size,decode_workers=args.decode_workers,queue_depth=args.queue_depth,
+                          shards=args.shards,precision=args.precision or None,indexes=indexes,
+                          pca_dimension=args.pca_dimension,pca_whiten=args.pca_whiten,
+                          embedding_cache_path=args.embedding_cache,embedding_cache_size_mb=args.embedding_cache_size_mb,
+                          report_interval=args.report_interval)
+    indexer.run(args.image_folder)
@@ -1,68 +1,398 @@
 import argparse
 import os.path
+import sys
 import json
+import time
+import hashlib
+import csv
+import shutil
+import tempfile
+import zipfile
+import base64
+from io import BytesIO
 from PIL import Image
 
 from crocodl.runtime.image_store import ImageStore
+from crocodl.runtime.sharded_image_store import ShardedImageStore
+from crocodl.runtime.search_engine import SearchEngine
 from crocodl.runtime.image_utils import ImageUtils
+from crocodl.runtime.image_pipeline import ImagePipeline
+from crocodl.runtime.embedding_cache import EmbeddingCache
+from crocodl.runtime.result_cache import ResultCache
+from crocodl.runtime.load_journal import LoadJournal
 from crocodl.runtime.http_utils import StatusServer, set_status
+from crocodl.runtime.search_utils import SearchServer
 
 from crocodl.runtime.model_utils import createModelUtils
 
 class SearchTool(object):
 
-    def __init__(self,architecture,db_path):
+    # images in a loaded folder may be tagged by a CSV file with this name in the folder
+    TAGS_FILENAME = "tags.csv"
+
+    def __init__(self,architecture,db_path,indexes=None,search_mode=SearchEngine.MODE_EXACT,nprobe=None,rerank=None,
+                 pca_dimension=0,pca_whiten=False,batch_size=32,decode_workers=4,queue_depth=64,shards=1,precision=None,
+                 embedding_cache_path=None,embedding_cache_size_mb=1024,result_cache_size=1000):
         self.architecture = architecture
         self.db_path = db_path
+        self.indexes = indexes
+        self.search_mode = search_mode
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.pca_dimension = pca_dimension
+        self.pca_whiten = pca_whiten
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        self.queue_depth = queue_depth
+        self.shards = shards
+        self.precision = precision
+        self.result_cache = ResultCache(result_cache_size)
+        self.embedding_cache = None
+        if embedding_cache_path:
+            self.embedding_cache = EmbeddingCache(embedding_cache_path, embedding_cache_size_mb*1024*1024)
 
     def open(self):
+        self.open_store()
+        self.model_utils = createModelUtils(self.architecture)
+        self.embedding_model = self.model_utils.createEmbeddingModel()
+
+    def open_store(self):
+        # open (or create) the image store, without loading the model
+        self.imagestore = None
         if os.path.exists(self.db_path):
-            self.imagestore = ImageStore(self.db_path)
+            self.imagestore = ShardedImageStore.openStore(self.db_path)
             existing_architecture = self.imagestore.getArchitecture()
             if existing_architecture != self.architecture:
-                os.unlink(self.db_path)
+                ShardedImageStore.deleteStore(self.db_path)
                 self.imagestore = None
         if not self.imagestore:
-            self.imagestore = ImageStore(self.db_path)
-            self.imagestore.setArchitecture(self.architecture)
+            self.imagestore = ShardedImageStore.openStore(self.db_path,self.shards)
+            self.imagestore.setArchitecture(self.architecture,self.precision)
+        elif self.precision and self.precision != self.imagestore.getPrecision():
+            self.imagestore.setPrecision(self.precision)
+        if self.indexes is not None:
+            self.imagestore.setIndexes(self.indexes)
 
         self.architecture = self.imagestore.getArchitecture()
-        self.model_utils = createModelUtils(self.architecture)
-        self.embedding_model = self.model_utils.createEmbeddingModel()
 
-    def search(self,image_path):
-        image = Image.open(image_path)
-        scores = self.model_utils.getEmbedding(self.embedding_model, self.model_utils.prepare(image))
-        matches = self.imagestore.similaritySearch(scores, firstN=3)
-        matches = list(map(lambda x:(x[0],x[1],ImageUtils.ImageToDataUri(x[2], 160)),matches))
-        return matches
+    def search(self,image_path,top_n=3,offset=0,threshold=None,filters=None):
+        # return a page of top_n matches starting at offset, ranked by decreasing similarity and, if threshold
+        # is specified, only including matches with similarity >= threshold (top_n=None for all such matches)
+        # filters may restrict the search to a path "prefix" and/or images with all of a list of "tags"
+        # thumbnails are only fetched for the matches in the page
+        # results are cached until the store is modified, the result cache's statistics are included in the result
+        scores = self.embed_file(image_path)
+        generation = self.imagestore.getGeneration()
+        key = ResultCache.makeKey(scores, top_n, offset, threshold, filters,
+                                  self.search_mode, self.nprobe, self.rerank)
+        result = self.result_cache.get(generation, key)
+        if result is None:
+            result = self.search_embedding(scores, top_n, offset, threshold, filters)
+            self.result_cache.put(generation, key, result)
+        return dict(result, result_cache=self.result_cache.getStats())
 
-    def load_images(self,folder):
-        self.imagestore.open()
+    def search_embedding(self,scores,top_n,offset,threshold,filters):
+        if top_n is None and threshold is None:
+            # would return (and fetch the thumbnail of) every image in the store
+            raise Exception("A threshold is required to search for all matches")
+        # search for one more match than requested, to find out whether there is a following page
+        matches = self.imagestore.rankedSearch(scores, None if top_n is None else top_n+1, mode=self.search_mode,
+                                               nprobe=self.nprobe, rerank=self.rerank,
+                                               threshold=threshold, offset=offset, filters=filters)
+        has_more = top_n is not None and len(matches) > top_n
+        matches = matches[:top_n]
+        images = self.imagestore.fetchImages([path for (path,_) in matches])
+        matches = list(map(lambda x:(x[0],x[1],ImageUtils.ImageToDataUri(images.get(x[0],None), 160)),matches))
+        return {"matches":matches, "offset":offset, "has_more":has_more}
+
+    def embed_file(self,image_path):
+        # compute the embedding for an image file, using the embedding cache if there is one
+        if not self.embedding_cache:
+            return self.model_utils.getEmbedding(self.embedding_model, self.model_utils.prepare(Image.open(image_path)))
+        with open(image_path,"rb") as f:
+            data = f.read()
+        content_hash = hashlib.sha1(data).hexdigest()
+        cached = self.embedding_cache.get(self.architecture, content_hash)
+        if cached:
+            self.embedding_cache.touch(self.architecture, [content_hash])
+            return cached[0]
+        image = Image.open(BytesIO(data))
+        embedding = self.model_utils.getEmbedding(self.embedding_model, self.model_utils.prepare(image))
+        self.embedding_cache.put(self.architecture, [(content_hash, embedding, ImageUtils.encodeThumbnailBytes(image))])
+        return embedding
+
+    def batch_search(self,query_path,results_path,firstN=3,memory_budget_mb=256):
+        # search for each image in a folder or zip file of query images, writing one result per query to
+        # results_path as JSON lines, or as rows of query,rank,path,similarity if results_path ends with .csv
+        # queries are embedded in batches of batch_size (or taken from the embedding cache if there is one), then
+        # as many queries as fit within the memory budget are searched together in a single matrix product
+        query_folder = query_path
+        tmp_folder = None
+        if zipfile.is_zipfile(query_path):
+            tmp_folder = tempfile.mkdtemp()
+            with zipfile.ZipFile(query_path) as zf:
+                zf.extractall(tmp_folder)
+            query_folder = tmp_folder
+        try:
+            import glob
+            filepaths = (filepath for filepath in glob.iglob(query_folder + '/**', recursive=True) if os.path.isfile(filepath))
+            pipeline = ImagePipeline(self.decode_query, self.decode_workers, self.queue_depth)
+            as_csv = results_path.lower().endswith(".csv")
+            self.query_count = 0
+            memory_budget = memory_budget_mb*1024*1024
+            store_size = len(self.imagestore)
+            with open(results_path,"w",newline="") as f:
+                writer = csv.writer(f) if as_csv else None
+                if writer:
+                    writer.writerow(["query","rank","path","similarity"])
+                (batch, queries) = ([], [])
+                for (filepath, decoded, ex) in pipeline.run(filepaths):
+                    if ex is not None:
+                        print("%s: %s"%(filepath,str(ex)))
+                        continue
+                    batch.append((os.path.relpath(filepath, start=query_folder),) + decoded)
+                    if len(batch) >= self.batch_size:
+                        queries += self.embed_queries(batch)
+                        batch = []
+                        # the scores (and the queries themselves) for a chunk of queries must fit within the budget
+                        if 4*len(queries)*(store_size+len(queries[0][1])) >= memory_budget:
+                            self.search_queries(queries, f, writer, firstN, memory_budget)
+                            queries = []
+                if batch:
+                    queries += self.embed_queries(batch)
+                if queries:
+                    self.search_queries(queries, f, writer, firstN, memory_budget)
+        finally:
+            if tmp_folder:
+                shutil.rmtree(tmp_folder, ignore_errors=True)
+        set_status({"status":"Searched %d images"%(self.query_count),
+                    "latest_image_path":"","latest_image_uri":"","database_size":len(self.imagestore)})
+
+    def decode_query(self,filepath):
+        # runs on a pipeline worker thread: returns (image_data, thumbnail, content_hash, None) for a query image,
+        # or (None, None, content_hash, embedding) if the embedding cache holds the image's content
+        if not self.embedding_cache:
+            return (self.model_utils.prepare(Image.open(filepath)), None, None, None)
+        with open(filepath,"rb") as f:
+            data = f.read()
+        content_hash = hashlib.sha1(data).hexdigest()
+        cached = self.embedding_cache.get(self.architecture, content_hash)
+        if cached:
+            return (None, None, content_hash, cached[0])
+        image = Image.open(BytesIO(data))
+        return (self.model_utils.prepare(image), ImageUtils.encodeThumbnailBytes(image), content_hash, None)
+
+    def embed_queries(self,batch):
+        # return (relpath, embedding) for each (relpath, image_data, thumbnail, content_hash, embedding) in batch,
+        # only entries without an embedding from the embedding cache are embedded
+        embeddings = [embedding for (_,_,_,_,embedding) in batch]
+        uncached = [idx for (idx,embedding) in enumerate(embeddings) if embedding is None]
+        if uncached:
+            computed = self.model_utils.getEmbeddings(self.embedding_model, [batch[idx][1] for idx in uncached])
+            for (idx,embedding) in zip(uncached,computed):
+                embeddings[idx] = embedding
+        if self.embedding_cache:
+            self.embedding_cache.put(self.architecture, [(batch[idx][3], embeddings[idx], batch[idx][2])
+                                                         for idx in uncached])
+            self.embedding_cache.touch(self.architecture, [content_hash for (_,_,_,content_hash,embedding) in batch
+                                                           if embedding is not None])
+        return [(relpath, embedding) for ((relpath,_,_,_,_),embedding) in zip(batch,embeddings)]
 
-        def process(relpath, image):
-            image_data = self.model_utils.prepare(image)
-            if image_data is not None:
-                scores = self.model_utils.getEmbedding(self.embedding_model, image_data)
-                self.imagestore.addEmbedding(relpath, scores, image)
+    def search_queries(self,queries,f,writer,firstN,memory_budget):
+        results = self.imagestore.batchSimilaritySearch([embedding for (_,embedding) in queries], firstN, memory_budget)
+        for ((relpath,_),matches) in zip(queries,results):
+            if writer:
+                for (rank,(path,similarity)) in enumerate(matches):
+                    writer.writerow([relpath,rank+1,path,similarity])
+            else:
+                f.write(json.dumps({"query":relpath,
+                                    "matches":[{"path":path,"similarity":similarity} for (path,similarity) in matches]})+"\n")
+        f.flush()
+        self.query_count += len(queries)
+        set_status({"status":"Searched %d images"%(self.query_count),
+                    "latest_image_path":queries[-1][0],"latest_image_uri":"","database_size":len(self.imagestore)})
 
-        counter = 0
+    def find_duplicates(self,threshold):
+        progress_cb = lambda status:set_status({"status":status,"latest_image_path":"","latest_image_uri":"",
+                                                "database_size":len(self.imagestore)})
+        progress_cb("Finding duplicates")
+        groups = self.imagestore.findDuplicates(threshold,progress_cb=progress_cb)
+        progress_cb("Found %d groups of duplicates"%(len(groups)))
+        return groups
+
+    def decode_image(self,filepath):
+        # runs on a pipeline worker thread: decode and prepare the image and encode its thumbnail
+        # returns None if the file is already stored with the same size and modification time,
+        # (None, None, file_info, None) if the file's content hash is unchanged and
+        # (None, thumbnail, file_info, embedding) if the embedding cache holds the file's content
+        relpath = os.path.relpath(filepath, start=self.load_folder)
+        stat = os.stat(filepath)
+        known = self.file_info.get(relpath, None)
+        if known and known[1] == stat.st_size and known[2] == stat.st_mtime:
+            return None
+        if self.journal.isFailed(relpath, stat.st_size, stat.st_mtime):
+            # could not be read by an earlier attempt at this load
+            return None
+        with open(filepath,"rb") as f:
+            data = f.read()
+        file_info = (hashlib.sha1(data).hexdigest(), stat.st_size, stat.st_mtime)
+        if known and known[0] == file_info[0]:
+            return (None, None, file_info, None)
+        if self.embedding_cache:
+            cached = self.embedding_cache.get(self.architecture, file_info[0])
+            if cached:
+                (embedding, thumbnail) = cached
+                return (None, thumbnail, file_info, embedding)
+        image = Image.open(BytesIO(data))
+        image_data = self.model_utils.prepare(image)
+        return (image_data, ImageUtils.encodeThumbnailBytes(image), file_info, None)
+
+    def load_images(self,folder,filepaths=None):
+        # load the images in folder, or only the listed filepaths (within folder) if specified
+        # the folder's tags file is only applied when loading the whole folder
+        # progress is recorded in a load journal after each batch, an unfinished load of the same folder is
+        # resumed and the load stops as soon as it is cancelled, discarding any batch not yet embedded
+        # (see LoadJournal)
+        self.imagestore.open()
+        self.loaded_count = 0
+        self.skipped_count = 0
+        self.cached_count = 0
+        self.load_folder = folder
+        self.file_info = self.imagestore.getFileInfo()
+        self.journal = LoadJournal(self.db_path)
+        resumed_count = self.journal.begin(folder)
+        if resumed_count is not None:
+            set_status({"status":"Resuming load, %d images already processed"%(resumed_count),
+                        "latest_image_path":"","latest_image_uri":"","database_size":len(self.imagestore)})
+        unchanged = []
+        unjournaled_count = 0
+        cancelled = False
+        self.timings = {"inference_seconds":0.0, "store_seconds":0.0}
+        self.load_start = time.time()
+
+        # images are decoded and prepared by the pipeline's workers while the previous batch is embedded
+        # and stored, batches of batch_size images are embedded in a single forward pass
         import glob
-        for filepath in glob.iglob(folder + '/**', recursive=True):
-            if os.path.isfile(filepath):
-                try:
-                    image = Image.open(filepath)
-                    relpath = os.path.relpath(filepath, start=folder)
-                    process(relpath, image)
-                    counter += 1
-                    if counter % 10 == 0:
-                        set_status({"status":"Loaded %d images"%(counter),
-                                    "latest_image_path":relpath,
-                                    "latest_image_uri":ImageUtils.ImageToDataUri(image, 160),
-                                    "database_size":len(self.imagestore)})
-                except Exception as ex:
-                    print(str(ex))
+        tags_path = os.path.join(folder, SearchTool.TAGS_FILENAME)
+        if filepaths is None:
+            filepaths = (filepath for filepath in glob.iglob(folder + '/**', recursive=True)
+                         if os.path.isfile(filepath) and filepath != tags_path)
+        else:
+            tags_path = None
+        self.pipeline = ImagePipeline(lambda filepath:self.decode_image(filepath), self.decode_workers, self.queue_depth)
+        batch = []
+        for (filepath, result, ex) in self.pipeline.run(filepaths):
+            # checked for each image, so that the batch being gathered is not embedded once the load is cancelled
+            if self.journal.isCancelled():
+                cancelled = True
+                break
+            relpath = os.path.relpath(filepath, start=folder)
+            unjournaled_count += 1
+            if ex is not None:
+                print("%s: %s"%(filepath,str(ex)))
+                if os.path.isfile(filepath):
+                    stat = os.stat(filepath)
+                    self.journal.recordFailure(relpath, stat.st_size, stat.st_mtime, str(ex))
+                continue
+            if result is None or result[1] is None:
+                # skip images already in the store with unchanged content
+                self.skipped_count += 1
+                if result is not None:
+                    unchanged.append((relpath, result[2]))
+                continue
+            (image_data, thumbnail, file_info, embedding) = result
+            batch.append((relpath, thumbnail, image_data, file_info, embedding))
+            if len(batch) >= self.batch_size:
+                self.load_batch(batch, unjournaled_count)
+                (batch, unjournaled_count) = ([], 0)
+        if batch and not cancelled and self.journal.isCancelled():
+            cancelled = True
+        if cancelled:
+            # the images in the discarded batch are loaded when the load is resumed
+            unjournaled_count -= len(batch)
+            batch = []
+        if batch:
+            self.load_batch(batch, unjournaled_count)
+        elif unjournaled_count:
+            self.journal.recordBatch([], unjournaled_count)
+        if unchanged:
+            self.imagestore.updateFileInfo(unchanged)
+        if cancelled:
+            self.imagestore.close()
+            self.journal.finish(LoadJournal.STATE_CANCELLED)
+            set_status({"status":"Load cancelled, %d images loaded"%(self.journal.getCounts()[1]),
+                        "latest_image_path":"","latest_image_uri":"","database_size":len(self.imagestore)})
+            return
+        if tags_path and os.path.isfile(tags_path):
+            self.imagestore.setTags(self.read_tags(tags_path))
         self.imagestore.close()
+        self.journal.finish(LoadJournal.STATE_COMPLETE)
+        if self.pca_dimension and not self.imagestore.isEmpty() and self.imagestore.getProjection() is None:
+            set_status({"status":"Fitting projection to %d dimensions"%(self.pca_dimension),
+                        "latest_image_path":"","latest_image_uri":"","database_size":len(self.imagestore)})
+            self.imagestore.fitProjection(self.pca_dimension,self.pca_whiten)
+
+    def read_tags(self,tags_path):
+        # each row of the tags file holds an image path (relative to the folder) followed by any number of tags
+        path_tags = {}
+        with open(tags_path, newline="") as f:
+            for row in csv.reader(f):
+                if row and row[0].strip():
+                    path_tags.setdefault(row[0].strip(), set()).update(tag.strip() for tag in row[1:] if tag.strip())
+        return list(path_tags.items())
+
+    def load_batch(self,batch,processed_count):
+        # store a batch and record it in the load journal, processed_count counts the files (including any
+        # skipped or failed) processed since the previous batch
+        loaded = self.process_batch(batch)
+        self.journal.recordBatch([relpath for (relpath,_,_,_,_) in batch] if loaded else [], processed_count)
+
+    def process_batch(self,batch):
+        # batch entries are (relpath, thumbnail, image_data, file_info, embedding), only entries without an
+        # embedding from the embedding cache are embedded
+        # returns True if the batch was stored
+        try:
+            embeddings = [embedding for (_,_,_,_,embedding) in batch]
+            uncached = [idx for (idx,embedding) in enumerate(embeddings) if embedding is None]
+            if uncached:
+                start = time.time()
+                computed = self.model_utils.getEmbeddings(self.embedding_model, [batch[idx][2] for idx in uncached])
+                self.timings["inference_seconds"] += time.time() - start
+                for (idx,embedding) in zip(uncached,computed):
+                    embeddings[idx] = embedding
+            start = time.time()
+            self.imagestore.addEmbeddings([(relpath, embedding, thumbnail, file_info)
+                                           for ((relpath,thumbnail,_,file_info,_),embedding) in zip(batch,embeddings)])
+            if self.embedding_cache:
+                self.embedding_cache.put(self.architecture, [(batch[idx][3][0], embeddings[idx], batch[idx][1])
+                                                             for idx in uncached])
+                self.embedding_cache.touch(self.architecture, [file_info[0] for (_,_,_,file_info,embedding) in batch
+                                                               if embedding is not None])
+            self.timings["store_seconds"] += time.time() - start
+        except Exception as ex:
+            print(str(ex))
+            return False
+        self.loaded_count += len(batch)
+        self.cached_count += len(batch) - len(uncached)
+        (relpath, thumbnail, _, _, _) = batch[-1]
+        set_status({"status":"Loaded %d images (%d unchanged, %d from cache)"%(self.loaded_count,self.skipped_count,
+                                                                             self.cached_count),
+                    "latest_image_path":relpath,
+                    "latest_image_uri":'data:image/jpeg;base64,'+base64.b64encode(thumbnail).decode("utf-8"),
+                    "database_size":len(self.imagestore),
+                    "timings":self.get_timings()})
+        return True
+
+    def get_timings(self):
+        # decode_seconds is summed over the pipeline workers, decode_wait_seconds is the time spent waiting
+        # for decoded images - if this is large relative to inference_seconds, decoding is the bottleneck
+        elapsed = time.time() - self.load_start
+        timings = dict(self.timings)
+        timings["decode_seconds"] = self.pipeline.busy_seconds
+        timings["decode_wait_seconds"] = self.pipeline.wait_seconds
+        timings["elapsed_seconds"] = elapsed
+        timings["images_per_second"] = self.loaded_count / elapsed if elapsed > 0 else 0.0
+        return timings
 
 if __name__ == '__main__':
 
@@ -81,17 +411,110 @@ if __name__ == '__main__':
                     type=int, default=9099, metavar="<TRACKER-PORT>")
     parser.add_argument("--architecture", help="the architecture of the model",
                         type=str, default="", metavar="<ARCHITECTURE>")
+    parser.add_argument("--indexes", help="comma separated list of indexes to maintain (ivf,pq,binary,coarse), or none",
+                        type=str, default="", metavar="<INDEXES>")
+    parser.add_argument("--nlist", help="number of IVF lists (default: chosen from the size of the store)",
+                        type=int, default=0, metavar="<NLIST>")
+    parser.add_argument("--pq_m", help="number of PQ sub-quantizers, the bytes per image (default: dimension/16)",
+                        type=int, default=0, metavar="<PQ-M>")
+    parser.add_argument("--binary_bits", help="number of bits in each binary code (default: 256)",
+                        type=int, default=0, metavar="<BINARY-BITS>")
+    parser.add_argument("--coarse_dimension", help="dimension of the coarse index's projection (default: 64)",
+                        type=int, default=0, metavar="<COARSE-DIMENSION>")
+    parser.add_argument("--search_mode", help="search mode (exact, ivf, pq, binary or coarse)",
+                        type=str, default=SearchEngine.MODE_EXACT, metavar="<SEARCH-MODE>")
+    parser.add_argument("--nprobe", help="number of IVF lists to scan in ivf search mode (more lists - better recall but slower)",
+                        type=int, default=0, metavar="<NPROBE>")
+    parser.add_argument("--rerank", help="number of pq, binary or coarse search candidates to re-rank exactly (0 - no re-ranking, default: depends on the mode)",
+                        type=int, default=None, metavar="<RERANK>")
+    parser.add_argument("--pca_dimension", help="once images are loaded, reduce stored embeddings to this dimension using PCA",
+                        type=int, default=0, metavar="<PCA-DIMENSION>")
+    parser.add_argument("--pca_whiten", help="whiten the PCA projection", action="store_true")
+    parser.add_argument("--shards", help="when creating a new store, split it across this many shard databases",
+                        type=int, default=1, metavar="<SHARDS>")
+    parser.add_argument("--precision", help="precision of the embeddings scanned by searches (float32, float16 or int8)",
+                        type=str, default="", metavar="<PRECISION>")
+    parser.add_argument("--embedding_cache", help="path to a cache of embeddings shared between stores and load jobs",
+                        type=str, default="", metavar="<EMBEDDING-CACHE>")
+    parser.add_argument("--embedding_cache_size_mb", help="maximum size of the embedding cache in MB",
+                        type=int, default=1024, metavar="<EMBEDDING-CACHE-SIZE-MB>")
+    parser.add_argument("--batch_size", help="number of images to embed in each forward pass when loading",
+                        type=int, default=32, metavar="<BATCH-SIZE>")
+    parser.add_argument("--decode_workers", help="number of threads decoding and resizing images when loading",
+                        type=int, default=4, metavar="<DECODE-WORKERS>")
+    parser.add_argument("--queue_depth", help="maximum number of decoded images waiting to be embedded",
+                        type=int, default=64, metavar="<QUEUE-DEPTH>")
+    parser.add_argument("--cancel_load", help="ask a running load into the database to stop",
+                        action="store_true")
+    parser.add_argument("--batch_queries", help="specify a folder or zip file of images to search for",
+                        type=str, default="", metavar="<BATCH-QUERIES>")
+    parser.add_argument("--batch_results_path", help="specify the path to write batch search results (.jsonl or .csv)",
+                        type=str, default="", metavar="<BATCH-RESULTS-PATH>")
+    parser.add_argument("--offset", help="rank of the first match to return, to page through search results",
+                        type=int, default=0, metavar="<OFFSET>")
+    parser.add_argument("--threshold", help="only return matches with at least this similarity",
+                        type=float, default=None, metavar="<THRESHOLD>")
+    parser.add_argument("--prefix", help="only search images whose path starts with this prefix",
+                        type=str, default="", metavar="<PREFIX>")
+    parser.add_argument("--tags", help="comma separated list of tags, only search images with all of these tags",
+                        type=str, default="", metavar="<TAGS>")
+    parser.add_argument("--top_n", help="number of matches to return for each search or batch query",
+                        type=int, default=3, metavar="<TOP-N>")
+    parser.add_argument("--memory_budget_mb", help="memory budget in MB for the scores of each chunk of batch queries",
+                        type=int, default=256, metavar="<MEMORY-BUDGET-MB>")
+    parser.add_argument("--duplicate_threshold", help="find groups of near-duplicate images with at least this similarity",
+                        type=float, default=0.0, metavar="<DUPLICATE-THRESHOLD>")
+    parser.add_argument("--duplicates_path", help="specify the path to write the groups of near-duplicate images (JSON)",
+                        type=str, default="", metavar="<DUPLICATES-PATH>")
+    parser.add_argument("--benchmark", help="measure the recall and latency of each search mode using this many queries",
+                        type=int, default=0, metavar="<BENCHMARK>")
+    parser.add_argument("--result_cache_size", help="number of search results cached by the search service (0 - no caching)",
+                        type=int, default=1000, metavar="<RESULT-CACHE-SIZE>")
+    parser.add_argument("--port", help="serve searches on this port, keeping the model and image store loaded",
+                        type=int, default=0, metavar="<PORT>")
+    parser.add_argument("--idle_timeout", help="when serving searches, exit after this many seconds without a request",
+                        type=int, default=600, metavar="<IDLE-TIMEOUT>")
 
     args = parser.parse_args()
+    if args.cancel_load:
+        LoadJournal(args.db_path).cancel()
+        sys.exit(0)
     st = None
     if args.tracker_port > -1:
         st = StatusServer(args.tracker_port)
         st.start()
-    st = SearchTool(args.architecture,args.db_path)
+    indexes = None
+    if args.indexes:
+        settings = {ImageStore.INDEX_IVF:args.nlist, ImageStore.INDEX_PQ:args.pq_m, ImageStore.INDEX_BINARY:args.binary_bits,
+                    ImageStore.INDEX_COARSE:args.coarse_dimension}
+        indexes = {name:settings[name] for name in args.indexes.split(",") if name in settings}
+    st = SearchTool(args.architecture,args.db_path,indexes=indexes,
+                    search_mode=args.search_mode,nprobe=args.nprobe,rerank=args.rerank,
+                    pca_dimension=args.pca_dimension,pca_whiten=args.pca_whiten,batch_size=args.batch_size,
+                    decode_workers=args.decode_workers,queue_depth=args.queue_depth,shards=args.shards,
+                    precision=args.precision or None,embedding_cache_path=args.embedding_cache,
+                    embedding_cache_size_mb=args.embedding_cache_size_mb,result_cache_size=args.result_cache_size)
     st.open()
     if args.image_folder:
         st.load_images(args.image_folder)
     if args.image_path:
-        results = st.search(args.image_path)
+        filters = {"prefix":args.prefix, "tags":[tag for tag in args.tags.split(",") if tag]}
+        if not filters["prefix"] and not filters["tags"]:
+            filters = None
+        results = st.search(args.image_path,args.top_n,args.offset,args.threshold,filters)
+        if args.results_path:
+            open(args.results_path,"w").write(json.dumps(results))
+    if args.batch_queries and args.batch_results_path:
+        st.batch_search(args.batch_queries,args.batch_results_path,args.top_n,args.memory_budget_mb)
+    if args.duplicate_threshold:
+        groups = st.find_duplicates(args.duplicate_threshold)
+        if args.duplicates_path:
+            open(args.duplicates_path,"w").write(json.dumps(groups))
+    if args.benchmark:
+        results = st.imagestore.benchmark(args.benchmark,args.top_n,args.nprobe,args.rerank)
+        print(json.dumps(results,indent=4))
         if args.results_path:
             open(args.results_path,"w").write(json.dumps(results))
+    if args.port:
+        ss = SearchServer(args.port,st,args.idle_timeout)
+        ss.start()
@@ -21,31 +21,103 @@ import os.path
 from crocodl.utils.web.browser import Browser
 import subprocess
 import sys
-import json
 import requests
+from time import sleep
 
 from crocodl.utils.code_utils import specialise_imports, expand_imports
-from crocodl.runtime.image_store import ImageStore
+from crocodl.runtime.sharded_image_store import ShardedImageStore
+from crocodl.runtime.load_journal import LoadJournal
 
 class Searchable(object):
 
-	def __init__(self,imagestore_path,architecture,folder):
+	# seconds to wait for the search service to respond to a search
+	SEARCH_TIMEOUT = 300
+
+	def __init__(self,imagestore_path,architecture,folder,search_mode="exact",nprobe=0,rerank=None,
+				 embedding_cache_path=None):
 		self.imagestore_path = imagestore_path
 		self.architecture = architecture
 		self.folder = folder
+		self.search_mode = search_mode
+		self.nprobe = nprobe
+		self.rerank = rerank
+		self.embedding_cache_path = embedding_cache_path
+		self.proc = None
+		self.port = None
+		self.idle_timeout = 600
 
 	def clear(self):
-		os.path.unlink(self.imagestore_path)
+		self.close()
+		ShardedImageStore.deleteStore(self.imagestore_path)
+
+	def startServer(self):
+		# start a search service process, unless one is already running
+		if self.proc is None or self.proc.poll() is not None:
+			script_path = os.path.join(self.folder, "search_tool.py")
+
+			with open(script_path, "w") as f:
+				f.write(Searchable.getCode(self.architecture))
+
+			self.port = Browser.getEphemeralPort()
+			self.proc = subprocess.Popen([sys.executable, script_path,
+									  "--db_path", self.imagestore_path,
+									  "--tracker_port", "-1",
+									  "--port", str(self.port),
+									  "--idle_timeout", str(self.idle_timeout),
+									  "--architecture", str(self.architecture),
+									  "--search_mode", self.search_mode,
+									  "--nprobe", str(self.nprobe)] + self.getCacheArgs() +
+									 ([] if self.rerank is None else ["--rerank", str(self.rerank)]),
+									 cwd=self.folder)
+
+	def getCacheArgs(self):
+		return ["--embedding_cache", self.embedding_cache_path] if self.embedding_cache_path else []
+
+	def close(self):
+		if self.proc is not None:
+			if self.proc.poll() is None:
+				self.proc.terminate()
+			self.proc = None
 
 	def __len__(self):
 		if os.path.exists(self.imagestore_path):
-			istore = ImageStore(self.imagestore_path)
+			istore = ShardedImageStore.openStore(self.imagestore_path)
 			return len(istore)
 		return 0
 
-	def search(self,image_path):
+	def search(self,image_path,top_n=3,offset=0,threshold=None,prefix="",tags=None):
+		# returns a page of results {"matches":[(path,similarity,image_uri)...],"offset":offset,"has_more":bool}
+		# top_n may be None to return all matches with similarity >= threshold
+		# prefix and tags restrict the search to images whose path starts with prefix and which have all of tags
+		self.startServer()
+		params = {"image_path":image_path,"offset":offset,
+				  "top_n":"" if top_n is None else top_n,
+				  "threshold":"" if threshold is None else threshold,
+				  "prefix":prefix,"tags":",".join(tags or [])}
+		restarted = False
+		while True:
+			try:
+				response = requests.get("http://localhost:"+str(self.port)+"/search",params=params,
+										timeout=Searchable.SEARCH_TIMEOUT)
+				if response.status_code == 200:
+					return response.json()
+				raise Exception("Search failed: "+response.json().get("error",""))
+			except requests.exceptions.ConnectionError:
+				# the service may still be loading the model, or may have exited on its idle timeout just
+				# before the request, in which case it is restarted (once)
+				if self.proc.poll() is not None:
+					if restarted:
+						raise Exception("Search service exited")
+					self.startServer()
+					restarted = True
+				sleep(0.5)
+			except requests.exceptions.Timeout:
+				raise Exception("Search service did not respond within %d seconds"%(Searchable.SEARCH_TIMEOUT))
+
+	def load(self,image_folder,progress_cb=None):
+		# an unfinished (cancelled or interrupted) load of the same folder is resumed
 		script_path = os.path.join(self.folder, "search_tool.py")
-		results_path = os.path.join(self.folder, "results.json")
+		LoadJournal(self.imagestore_path).clearCancel()
 
 		with open(script_path, "w") as f:
 			f.write(Searchable.getCode(self.architecture))
@@ -54,9 +126,8 @@ class Searchable(object):
 		proc = subprocess.Popen([sys.executable, script_path,
 									  "--db_path", self.imagestore_path,
 									  "--tracker_port", str(tracker_port),
-									  "--image_path", image_path,
-									  "--architecture", str(self.architecture),
-									 "--results_path", results_path],
+									  "--image_folder", image_folder,
+									  "--architecture", str(self.architecture)] + self.getCacheArgs(),
 									 cwd=self.folder)
 		running = True
 		while running:
@@ -64,10 +135,21 @@ class Searchable(object):
 				proc.wait(1)
 				running = False
 			except subprocess.TimeoutExpired:
-				pass
-		return json.loads(open(results_path).read())
+				self.checkStatus(progress_cb,tracker_port)
 
-	def load(self,image_folder,progress_cb=None):
+	def cancelLoad(self):
+		# ask a running load to stop (see LoadJournal.cancel)
+		LoadJournal(self.imagestore_path).cancel()
+
+	def getLoadJournal(self):
+		# return the journal of the most recent load (see LoadJournal) or None
+		return LoadJournal(self.imagestore_path).read()
+
+	def discardLoadJournal(self):
+		LoadJournal(self.imagestore_path).remove()
+
+	def batchSearch(self,query_path,results_path,firstN=3,progress_cb=None):
+		# search for every image in a folder or zip file of query images, writing matches to results_path
 		script_path = os.path.join(self.folder, "search_tool.py")
 
 		with open(script_path, "w") as f:
@@ -77,8 +159,10 @@ class Searchable(object):
 		proc = subprocess.Popen([sys.executable, script_path,
 									  "--db_path", self.imagestore_path,
 									  "--tracker_port", str(tracker_port),
-									  "--image_folder", image_folder,
-									  "--architecture", str(self.architecture)],
+									  "--batch_queries", query_path,
+									  "--batch_results_path", results_path,
+									  "--top_n", str(firstN),
+									  "--architecture", str(self.architecture)] + self.getCacheArgs(),
 									 cwd=self.folder)
 		running = True
 		while running:
@@ -88,15 +172,13 @@ class Searchable(object):
 			except subprocess.TimeoutExpired:
 				self.checkStatus(progress_cb,tracker_port)
 
-
-
 	def checkStatus(self,progress_cb,port):
 		try:
 			response = requests.get("http://localhost:" + str(port))
 			if response.status_code == 200:
 				jo = response.json()
 				if progress_cb:
-					progress_cb(jo["status"],jo["latest_image_path"],jo["latest_image_uri"],jo["database_size"])
+					progress_cb(jo["status"],jo["latest_image_path"],jo["latest_image_uri"],jo["database_size"],jo.get("timings",{}))
 		except:
 			pass
 
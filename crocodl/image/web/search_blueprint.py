@@ -53,6 +53,16 @@ class SearchBlueprint(object):
     def add_images(path):
         return jsonify(SearchBlueprint.instance.add_images(path,request.data))
 
+    @staticmethod
+    @search_blueprint.route('/cancel_load', methods=['POST'])
+    def cancel_load():
+        return jsonify(SearchBlueprint.instance.cancel_load())
+
+    @staticmethod
+    @search_blueprint.route('/resume_load', methods=['POST'])
+    def resume_load():
+        return jsonify(SearchBlueprint.instance.resume_load())
+
     @staticmethod
     @search_blueprint.route('/image_upload/<path:path>', methods=['POST'])
     def upload_image(path):
@@ -67,13 +77,25 @@ class SearchBlueprint(object):
     @staticmethod
     @search_blueprint.route('/database/<path:path>', methods=['GET'])
     def send_database(path):
-        (imagestore_dir, imagestore_filename) = SearchBlueprint.instance.send_database(path)
-        return send_from_directory(imagestore_dir, imagestore_filename)
+        (imagestore_dir, imagestore_filename, download_name) = SearchBlueprint.instance.send_database(path)
+        return send_from_directory(imagestore_dir, imagestore_filename, as_attachment=True, download_name=download_name)
 
     @staticmethod
     @search_blueprint.route('/search_image', methods=['POST'])
     def search_image():
-        return jsonify(SearchBlueprint.instance.search_image())
+        return jsonify(SearchBlueprint.instance.search_image(request.get_json(silent=True)))
+
+    @staticmethod
+    @search_blueprint.route('/batch_search/<path:path>', methods=['POST'])
+    def batch_search(path):
+        top_n = int(request.args.get("top_n", 3))
+        return jsonify(SearchBlueprint.instance.batch_search(path,request.data,top_n))
+
+    @staticmethod
+    @search_blueprint.route('/batch_results/<path:path>', methods=['GET'])
+    def send_batch_results(path):
+        (batch_dir, path) = SearchBlueprint.instance.send_batch_results(path)
+        return send_from_directory(batch_dir, path)
 
     @staticmethod
     @search_blueprint.route('/upload_database/<path:path>', methods=['POST'])
@@ -17,15 +17,18 @@
 
 import os.path
 import shutil
+import zipfile
 import threading
 from flask import current_app
+from werkzeug.utils import secure_filename
 
 # flask initialisation and configuration (see config.py)
 
 from crocodl.utils.log_utils import createLogger
 from crocodl.image.web.data_utils import unpack_data
 from crocodl.image.search.searchable import Searchable
-from crocodl.runtime.image_store import ImageStore
+from crocodl.runtime.sharded_image_store import ShardedImageStore
+from crocodl.runtime.load_journal import LoadJournal
 from crocodl.utils.web.code_formatter import CodeFormatter
 from crocodl.image.model_registry.registry import Registry
 from crocodl.image.model_registry.capability import Capability
@@ -41,14 +44,19 @@ class LoadThread(threading.Thread):
 
     def run(self):
         self.searcher.loading = True
-        self.searcher.get_searchable().load(self.data_dir, lambda s,p,i,ds:self.progress_cb(s,p,i,ds))
+        searchable = self.searcher.get_searchable()
+        searchable.load(self.data_dir, lambda s,p,i,ds,t:self.progress_cb(s,p,i,ds,t))
+        journal = searchable.getLoadJournal()
+        if journal and journal["state"] != LoadJournal.STATE_COMPLETE:
+            self.searcher.load_progress = "Load stopped after %d images, it can be resumed"%(journal["loaded_count"])
         self.searcher.loading = False
         self.searcher.load_complete()
 
-    def progress_cb(self,progress,latest_path,latest_image,database_size):
+    def progress_cb(self,progress,latest_path,latest_image,database_size,timings):
         self.searcher.load_progress = progress
         self.searcher.latest_load_path = latest_path
         self.searcher.latest_load_image = latest_image
+        self.searcher.load_timings = timings
         self.searcher.set_database_size(database_size)
 
     def update_db_info(self):
@@ -57,19 +65,52 @@ class LoadThread(threading.Thread):
 
 class SearchThread(threading.Thread):
 
-    def __init__(self, searcher,image_path):
+    def __init__(self, searcher, image_path, top_n=3, offset=0, threshold=None, prefix="", tags=None):
         super(SearchThread, self).__init__(target=self)
         self.searcher = searcher
         self.image_path = image_path
+        self.top_n = top_n
+        self.offset = offset
+        self.threshold = threshold
+        self.prefix = prefix
+        self.tags = tags
 
     def run(self):
         self.searcher.searching = True
         self.searcher.search_results = []
-        matches = self.searcher.get_searchable().search(self.image_path)
-        for (path, similarity, bestimage) in matches:
-            filename = os.path.split(path)[1]
-            self.searcher.search_results.append({"filename": filename, "similarity": similarity, "image": bestimage})
-        self.searcher.searching = False
+        try:
+            results = self.searcher.get_searchable().search(self.image_path, self.top_n, self.offset, self.threshold,
+                                                              self.prefix, self.tags)
+            self.searcher.search_offset = results["offset"]
+            self.searcher.search_has_more = results["has_more"]
+            self.searcher.result_cache_stats = results.get("result_cache", {})
+            for (path, similarity, bestimage) in results["matches"]:
+                filename = os.path.split(path)[1]
+                self.searcher.search_results.append({"filename": filename, "similarity": similarity, "image": bestimage})
+        except Exception as ex:
+            self.searcher.search_progress = "Search failed: " + str(ex)
+        finally:
+            self.searcher.searching = False
+
+class BatchSearchThread(threading.Thread):
+
+    def __init__(self, searcher, query_dir, results_path, top_n):
+        super(BatchSearchThread, self).__init__(target=self)
+        self.searcher = searcher
+        self.query_dir = query_dir
+        self.results_path = results_path
+        self.top_n = top_n
+
+    def run(self):
+        self.searcher.batch_searching = True
+        self.searcher.get_searchable().batchSearch(self.query_dir, self.results_path, self.top_n,
+                                                   lambda s,p,i,ds,t:self.progress_cb(s))
+        self.searcher.batch_progress = "Batch search complete"
+        self.searcher.batch_results_url = "batch_results/" + os.path.split(self.results_path)[1]
+        self.searcher.batch_searching = False
+
+    def progress_cb(self,progress):
+        self.searcher.batch_progress = progress
 
 class Searcher(object):
 
@@ -77,6 +118,9 @@ class Searcher(object):
         self.database_info = ""
         self.image_path = ""
         self.search_results= []
+        self.search_offset = 0
+        self.search_has_more = False
+        self.result_cache_stats = {}
         self.loading = False
         self.searching = False
         self.load_progress = ""
@@ -91,6 +135,10 @@ class Searcher(object):
         self.database_ready = False
         self.search_dir = ""
         self.database_size = 0
+        self.load_timings = {}
+        self.batch_searching = False
+        self.batch_progress = ""
+        self.batch_results_url = ""
 
 
     logger = createLogger("searcher")
@@ -107,7 +155,10 @@ class Searcher(object):
             os.makedirs(self.search_dir)
             self.search_folder = self.search_dir
             self.model_details = self.architecture
-            self.searchable = Searchable(self.imagestore_path,self.architecture,self.search_folder)
+            # the embedding cache is kept in the workspace, so that it outlives the image stores
+            embedding_cache_path = os.path.join(current_app.config["WORKSPACE_DIR"], "embedding_cache.db")
+            self.searchable = Searchable(self.imagestore_path,self.architecture,self.search_folder,
+                                         embedding_cache_path=embedding_cache_path)
         return self.searchable
 
     def get_configuration(self):
@@ -132,11 +183,31 @@ class Searcher(object):
             os.makedirs(data_dir)
 
             unpack_data(zip_path, data_dir)
+            # the folder now holds a new upload, so an unfinished load of the previous upload cannot be resumed
+            self.searchable.discardLoadJournal()
             lt = LoadThread(self,data_dir)
             lt.start()
 
         return {}
 
+    def cancel_load(self):
+        # the load stops once its current batch is stored
+        if self.loading:
+            self.load_progress = "Cancelling load"
+            self.get_searchable().cancelLoad()
+        return {}
+
+    def resume_load(self):
+        # resume a cancelled or interrupted load, if its (unpacked) folder is still available
+        if not self.loading and self.searchable:
+            journal = self.searchable.getLoadJournal()
+            if journal and journal["state"] != LoadJournal.STATE_COMPLETE and os.path.isdir(journal["folder"]):
+                self.loading = True
+                self.load_progress = "Resuming load"
+                lt = LoadThread(self,journal["folder"])
+                lt.start()
+        return {}
+
     def upload_image(self,path,data):
         image_dir = os.path.join(current_app.config["WORKSPACE_DIR"], "image")
         if os.path.isdir(image_dir):
@@ -153,19 +224,72 @@ class Searcher(object):
         return (image_dir,path)
 
     def send_database(self,path):
+        # returns (folder, filename, download_name), path (from the URL) is only used as the download name
+        imagestore = ShardedImageStore.openStore(self.imagestore_path)
+        imagestore.checkpoint()
         imagestore_dir = os.path.split(self.imagestore_path)[0]
         imagestore_filename = os.path.split(self.imagestore_path)[1]
-        return (imagestore_dir, imagestore_filename)
-
-    def search_image(self):
+        download_name = secure_filename(os.path.split(path)[1]) or imagestore_filename
+        if isinstance(imagestore, ShardedImageStore):
+            # download the manifest and shard databases together in a zip file, written alongside the store
+            # and renamed into place so that a concurrent download never sends a partial zip
+            imagestore_filename += ".zip"
+            zip_path = os.path.join(imagestore_dir, imagestore_filename)
+            tmp_path = "%s.%d.tmp"%(zip_path, threading.get_ident())
+            with zipfile.ZipFile(tmp_path, "w") as zf:
+                for store_path in [self.imagestore_path] + imagestore.shard_paths:
+                    zf.write(store_path, os.path.split(store_path)[1])
+            os.replace(tmp_path, zip_path)
+        return (imagestore_dir, imagestore_filename, download_name)
+
+    def search_image(self,settings=None):
+        # settings may specify top_n (the page size), offset (the rank of the first result in the page)
+        # and threshold (the minimum similarity of results), prefix and tags restrict the search to images
+        # whose path starts with prefix and which have all of the tags (loaded from tags.csv in the images zip)
+        settings = settings or {}
         self.get_searchable()
         self.search_progress = "Starting search..."
         if not self.searching:
-            st = SearchThread(self,self.image_path)
+            top_n = settings.get("top_n", 3)
+            threshold = settings.get("threshold", None)
+            st = SearchThread(self, self.image_path,
+                              None if top_n is None else int(top_n), int(settings.get("offset", 0)),
+                              None if threshold is None else float(threshold),
+                              settings.get("prefix", ""), settings.get("tags", []))
             st.start()
         return {}
 
+    def batch_search(self,path,data,top_n=3):
+        # search for every image in an uploaded zip file, results are written as JSON lines
+        self.get_searchable()
+        if not self.batch_searching:
+            self.batch_progress = "Starting batch search..."
+            self.batch_results_url = ""
+            batch_dir = os.path.join(current_app.config["WORKSPACE_DIR"], "batch")
+            if os.path.isdir(batch_dir):
+                shutil.rmtree(batch_dir)
+            query_dir = os.path.join(batch_dir, "queries")
+            os.makedirs(query_dir)
+
+            zip_path = os.path.join(batch_dir, path)
+            open(zip_path, "wb").write(data)
+            unpack_data(zip_path, query_dir)
+
+            results_path = os.path.join(batch_dir, "batch_results.jsonl")
+            bt = BatchSearchThread(self, query_dir, results_path, top_n)
+            bt.start()
+        return {}
+
+    def send_batch_results(self,path):
+        batch_dir = os.path.join(current_app.config["WORKSPACE_DIR"], "batch")
+        return (batch_dir,path)
+
     def upload_database(self,path,data):
+        if self.searchable:
+            self.searchable.close()
+            self.searchable = None
+        if self.imagestore_path:
+            ShardedImageStore.deleteStore(self.imagestore_path)
         parent_dir = os.path.join(current_app.config["WORKSPACE_DIR"], "image_store")
         if os.path.isdir(parent_dir):
             shutil.rmtree(parent_dir)
@@ -173,8 +297,19 @@ class Searcher(object):
 
         self.imagestore_path = os.path.join(parent_dir, path)
         open(self.imagestore_path, "wb").write(data)
-
-        imagestore = ImageStore(self.imagestore_path)
+        if zipfile.is_zipfile(self.imagestore_path):
+            # a sharded store, downloaded as a zip file containing its manifest and shard databases
+            zip_path = self.imagestore_path
+            unpack_data(zip_path, parent_dir)
+            os.unlink(zip_path)
+            manifests = [name for name in os.listdir(parent_dir)
+                         if ShardedImageStore.isSharded(os.path.join(parent_dir, name))]
+            if not manifests:
+                raise Exception("No sharded image store manifest found in "+path)
+            self.imagestore_path = os.path.join(parent_dir, manifests[0])
+
+        imagestore = ShardedImageStore.openStore(self.imagestore_path)
+        imagestore.syncSidecar()
         self.architecture = imagestore.getArchitecture()
         self.database_size = len(imagestore)
         self.database_info = self.refresh_database_info()
@@ -183,25 +318,33 @@ class Searcher(object):
         return {}
 
     def load_complete(self):
-        imagestore = ImageStore(self.imagestore_path)
+        imagestore = ShardedImageStore.openStore(self.imagestore_path)
         self.database_size = len(imagestore)
         self.database_info = self.refresh_database_info()
 
     def create_database(self,settings):
         self.architecture = settings["architecture"]
+        if self.searchable:
+            self.searchable.close()
+            self.searchable = None
+        if self.imagestore_path:
+            ShardedImageStore.deleteStore(self.imagestore_path)
         parent_dir = os.path.join(current_app.config["WORKSPACE_DIR"], "image_store")
         if os.path.isdir(parent_dir):
             shutil.rmtree(parent_dir)
         os.makedirs(parent_dir)
 
-        self.imagestore_path = os.path.join(parent_dir, "imagesearch.db")
+        # a store with more than one shard is a manifest listing the shard databases
+        shards = int(settings.get("shards", 1))
+        imagestore_filename = "imagesearch.json" if shards > 1 else "imagesearch.db"
+        self.imagestore_path = os.path.join(parent_dir, imagestore_filename)
 
-        image_store = ImageStore(self.imagestore_path)
-        image_store.setArchitecture(self.architecture)
+        image_store = ShardedImageStore.openStore(self.imagestore_path, shards)
+        image_store.setArchitecture(self.architecture, settings.get("precision", None))
         self.database_size = len(image_store)
         self.database_info = self.refresh_database_info()
         self.database_ready = True
-        self.imagestore_url = "database/imagesearch.db"
+        self.imagestore_url = "database/imagesearch.zip" if shards > 1 else "database/imagesearch.db"
         return {}
 
     def status(self):
@@ -217,11 +360,20 @@ class Searcher(object):
         }
         status["search_progress"] = self.search_progress
         status["load_progress"] = self.load_progress
+        status["load_resumable"] = self.is_load_resumable()
         if self.loading:
             status["latest_load_image"] = self.latest_load_image
             status["latest_load_path"] = self.latest_load_path
+            status["load_timings"] = self.load_timings
+        status["result_cache"] = self.result_cache_stats
+        status["batch_searching"] = self.batch_searching
+        status["batch_progress"] = self.batch_progress
+        if self.batch_results_url:
+            status["batch_results_url"] = self.batch_results_url
         if self.search_results:
             status["search_results"] = self.search_results
+            status["search_offset"] = self.search_offset
+            status["search_has_more"] = self.search_has_more
 
         if self.search_image_url:
             status["search_image_url"] = self.search_image_url
@@ -229,6 +381,12 @@ class Searcher(object):
         status["database_url"] = self.imagestore_url
         return status
 
+    def is_load_resumable(self):
+        if self.loading or not self.searchable:
+            return False
+        journal = self.searchable.getLoadJournal()
+        return journal is not None and journal["state"] != LoadJournal.STATE_COMPLETE
+
     def send_code(self):
         if self.architecture:
             cf = CodeFormatter()
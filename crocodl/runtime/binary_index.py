@@ -0,0 +1,89 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+
+from crocodl.runtime.projection import Projection
+from crocodl.runtime.vector_index import VectorIndex
+
+class BinaryIndex(VectorIndex):
+	"""
+	Binary hash codes.  Each embedding is projected onto a number of directions and the signs packed into a
+	bit string (256 bits by default, 32 bytes per image).  The directions are the principal components with an
+	iterative quantization (ITQ) rotation, or random directions when there are more bits than dimensions.
+	Searches rank rows by the Hamming distance between codes, computed with popcount, then exactly re-rank
+	the best candidates.
+	"""
+
+	SUFFIX = ".binary.npz"
+	MODEL_ARRAYS = ["rotation","mean"]
+	CODE_DTYPE = np.uint8
+
+	DEFAULT_BITS = 256
+
+	DEFAULT_RERANK = 200
+
+	ITQ_ITERATIONS = 50
+
+	# number of set bits in each byte value, when numpy does not provide bitwise_count
+	POPCOUNT = np.array([bin(value).count("1") for value in range(256)],dtype=np.uint8)
+
+	def getBits(self):
+		return self.rotation.shape[1]
+
+	def fit(self,matrix,bits):
+		bits = -(-(bits or BinaryIndex.DEFAULT_BITS) // 64) * 64
+		rng = np.random.RandomState(0)
+		sample = np.asarray(matrix[np.sort(rng.choice(len(matrix),min(len(matrix),20000),replace=False))],dtype=np.float32)
+		self.mean = sample.mean(axis=0)
+		dimension = matrix.shape[1]
+		if bits > dimension:
+			self.rotation = rng.standard_normal((dimension,bits)).astype(np.float32)
+			return
+		pca = Projection.fitPCA(sample,bits)
+		projected = (sample - self.mean).dot(pca.weights.T)
+		# ITQ - alternately fix the codes and solve for the orthogonal rotation minimizing the quantization error
+		(rotation,_) = np.linalg.qr(rng.standard_normal((bits,bits)))
+		for iteration in range(BinaryIndex.ITQ_ITERATIONS):
+			codes = np.sign(projected.dot(rotation))
+			(u,_,vt) = np.linalg.svd(projected.T.dot(codes))
+			rotation = u.dot(vt)
+		self.rotation = pca.weights.T.dot(rotation).astype(np.float32)
+
+	def encode(self,matrix):
+		return np.packbits((np.asarray(matrix,dtype=np.float32) - self.mean).dot(self.rotation) > 0,axis=1)
+
+	def distances(self,query,rows=None,chunk_size=65536):
+		# compute the Hamming distance between the query's code and the code of each row (or the given rows)
+		query_code = self.encode(query[None,:])
+		codes = self.codes if rows is None else self.codes[rows]
+		distances = np.zeros((len(codes),),dtype=np.int32)
+		for start in range(0,len(codes),chunk_size):
+			if hasattr(np,"bitwise_count"):
+				# codes are a multiple of 64 bits, count the differing bits 64 at a time
+				chunk = np.ascontiguousarray(codes[start:start+chunk_size]).view(np.uint64)
+				differences = np.bitwise_xor(chunk,query_code.view(np.uint64))
+				distances[start:start+len(differences)] = np.bitwise_count(differences).sum(axis=1)
+			else:
+				differences = np.bitwise_xor(codes[start:start+chunk_size],query_code)
+				distances[start:start+len(differences)] = BinaryIndex.POPCOUNT[differences].sum(axis=1)
+		return distances
+
+	def score(self,query,rows=None):
+		# estimate the cosine similarity between the query and each row (or the given rows) from the fraction
+		# of differing bits, as for random hyperplane hashing
+		return np.cos(np.pi * self.distances(query,rows) / self.getBits()).astype(np.float32)
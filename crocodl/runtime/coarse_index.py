@@ -0,0 +1,56 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+
+from crocodl.runtime.projection import Projection
+from crocodl.runtime.vector_index import VectorIndex
+
+class CoarseIndex(VectorIndex):
+	"""
+	A low dimensional copy of the embeddings for coarse-to-fine search.  Each embedding is projected onto the
+	leading principal components (64 by default) and held as float16, so that a first pass scanning every row
+	reads a small fraction of the full matrix.  The best few hundred candidates are then re-ranked exactly
+	using the full embeddings.
+	"""
+
+	SUFFIX = ".coarse.npz"
+	MODEL_ARRAYS = ["weights"]
+	CODE_DTYPE = np.float16
+
+	DEFAULT_DIMENSION = 64
+
+	DEFAULT_RERANK = 300
+
+	def fit(self,matrix,dimension):
+		dimension = min(dimension or CoarseIndex.DEFAULT_DIMENSION,matrix.shape[1])
+		sample = matrix[np.sort(np.random.RandomState(0).choice(len(matrix),min(len(matrix),20000),replace=False))]
+		# the projection is not centered, so that inner products between projected vectors approximate those
+		# between the full vectors
+		self.weights = Projection.fitPCA(sample,dimension).weights
+
+	def encode(self,matrix):
+		return np.asarray(matrix,dtype=np.float32).dot(self.weights.T).astype(np.float16)
+
+	def score(self,query,rows=None,chunk_size=65536):
+		# approximate the inner product between the query and each row (or the given rows)
+		projected = self.weights.dot(query)
+		codes = self.codes if rows is None else self.codes[rows]
+		scores = np.zeros((len(codes),),dtype=np.float32)
+		for start in range(0,len(codes),chunk_size):
+			scores[start:start+chunk_size] = np.asarray(codes[start:start+chunk_size],dtype=np.float32).dot(projected)
+		return scores
@@ -0,0 +1,95 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+
+class CompactMatrix(object):
+	"""
+	A read-only view of a matrix stored at reduced precision, either as float16 values or as int8 codes with a
+	per-column scale and offset (value = offset + scale * code).
+
+	Indexing returns float32 rows and dot products are computed in chunks, so that the full float32 matrix
+	is never materialized.
+	"""
+
+	PRECISION_FLOAT32 = "float32"
+	PRECISION_FLOAT16 = "float16"
+	PRECISION_INT8 = "int8"
+
+	PRECISIONS = [PRECISION_FLOAT32,PRECISION_FLOAT16,PRECISION_INT8]
+
+	CHUNK_SIZE = 65536
+
+	def __init__(self,data,scale=None,offset=None):
+		self.data = data
+		self.scale = scale
+		self.offset = offset
+		self.shape = data.shape
+		self.dtype = np.dtype(np.float32)
+
+	def __len__(self):
+		return len(self.data)
+
+	def __getitem__(self,index):
+		rows = np.asarray(self.data[index],dtype=np.float32)
+		if self.scale is not None:
+			rows = rows*self.scale + self.offset
+		return rows
+
+	def __array__(self,dtype=None,copy=None):
+		return np.asarray(self[:],dtype=dtype)
+
+	def dot(self,other):
+		# compute self . other, where other is a vector of length D or a D x K matrix
+		other = np.asarray(other,dtype=np.float32)
+		if self.scale is not None:
+			# (offset + scale * code) . other = code . (scale * other) + offset . other
+			(bias,other) = (self.offset.dot(other),(self.scale*other.T).T)
+		else:
+			bias = 0
+		result = np.zeros((len(self.data),)+other.shape[1:],dtype=np.float32)
+		for start in range(0,len(self.data),CompactMatrix.CHUNK_SIZE):
+			chunk = np.asarray(self.data[start:start+CompactMatrix.CHUNK_SIZE],dtype=np.float32)
+			result[start:start+len(chunk)] = chunk.dot(other) + bias
+		return result
+
+	@staticmethod
+	def fitQuantization(matrix):
+		# choose a per-column scale and offset mapping the range of each column of matrix onto the int8 codes,
+		# for an empty matrix the range [-1,1] of normalized vectors is assumed
+		if len(matrix):
+			low = matrix.min(axis=0)
+			high = matrix.max(axis=0)
+		else:
+			low = np.full((matrix.shape[1],),-1.0,dtype=np.float32)
+			high = np.full((matrix.shape[1],),1.0,dtype=np.float32)
+		scale = np.maximum(high-low,1e-6).astype(np.float32) / 255
+		offset = (low + 128*scale).astype(np.float32)
+		return (scale,offset)
+
+	@staticmethod
+	def encode(matrix,precision,scale=None,offset=None):
+		# convert a float32 matrix to its stored representation in the given precision
+		if precision == CompactMatrix.PRECISION_FLOAT16:
+			return matrix.astype(np.float16)
+		if precision == CompactMatrix.PRECISION_INT8:
+			return np.clip(np.rint((matrix-offset)/scale),-128,127).astype(np.int8)
+		return matrix.astype(np.float32)
+
+	@staticmethod
+	def getStorageDtype(precision):
+		return {CompactMatrix.PRECISION_FLOAT16:np.float16,CompactMatrix.PRECISION_INT8:np.int8}.get(precision,np.float32)
@@ -0,0 +1,103 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import sqlite3
+import threading
+import weakref
+
+class PooledConnection(object):
+	"""
+	Holds a thread's pooled connection in the pool's thread local storage, closing the connection once the
+	thread has finished and its thread local storage is released.
+	"""
+
+	def __init__(self,db):
+		self.db = db
+
+	def __del__(self):
+		self.db.close()
+
+class ConnectionPool(object):
+	"""
+	Hand out SQLite connections to a database, one per thread, configured for concurrent use:
+	write-ahead logging lets searches read the database while a loader is writing to it, and a busy
+	timeout makes connections wait for locks rather than failing with "database is locked".
+
+	Pools are shared by all users of a database within a process, obtain them with ConnectionPool.getPool.
+	A thread's connection is closed when the thread finishes, so that servers handling each request on a new
+	thread do not accumulate connections.
+	"""
+
+	PRAGMAS = [
+		"pragma page_size = 8192",         # only effective when the database is created
+		"pragma journal_mode = WAL",
+		"pragma synchronous = NORMAL",     # safe with WAL, a crash may lose the last commits but not corrupt
+		"pragma mmap_size = 268435456",
+		"pragma cache_size = -65536",      # 64MB
+		"pragma temp_store = MEMORY"
+	]
+
+	BUSY_TIMEOUT = 60
+
+	pools = {}
+	pools_lock = threading.Lock()
+
+	def __init__(self,path):
+		self.path = path
+		self.local = threading.local()
+		# the PooledConnection of each thread with a connection, dropped as threads finish
+		self.connections = weakref.WeakSet()
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def getPool(path):
+		with ConnectionPool.pools_lock:
+			if path not in ConnectionPool.pools:
+				ConnectionPool.pools[path] = ConnectionPool(path)
+			return ConnectionPool.pools[path]
+
+	@staticmethod
+	def closePool(path):
+		with ConnectionPool.pools_lock:
+			pool = ConnectionPool.pools.pop(path,None)
+		if pool:
+			pool.close()
+
+	def connect(self):
+		# open a new connection which is not managed by the pool
+		db = sqlite3.connect(self.path,timeout=ConnectionPool.BUSY_TIMEOUT,check_same_thread=False)
+		for pragma in ConnectionPool.PRAGMAS:
+			db.execute(pragma)
+		return db
+
+	def get(self):
+		# get the calling thread's connection
+		connection = getattr(self.local,"connection",None)
+		if connection is None:
+			connection = PooledConnection(self.connect())
+			self.local.connection = connection
+			with self.lock:
+				self.connections.add(connection)
+		return connection.db
+
+	def close(self):
+		with self.lock:
+			connections = list(self.connections)
+			self.connections = weakref.WeakSet()
+		for connection in connections:
+			connection.db.close()
+		self.local = threading.local()
@@ -0,0 +1,137 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import math
+import numpy as np
+
+METHOD_AUTO = "auto"
+METHOD_EXACT = "exact"
+METHOD_LSH = "lsh"
+
+# with METHOD_AUTO, stores with more rows than this are searched for duplicates using LSH
+EXACT_MAX_ROWS = 50000
+
+def similar_pairs(matrix,threshold,rows=None,memory_budget=256*1024*1024):
+	# find the pairs of rows of (normalized) matrix with similarity >= threshold, restricted to the given row
+	# indices if specified, comparing blocks of rows against the remaining rows in single matrix products
+	# with the block size limited so that each block's similarities fit within memory_budget bytes
+	# returns a pair of arrays (a,b) of row indices with a < b
+	if rows is None:
+		rows = np.arange(len(matrix))
+	block_size = max(1,min(len(rows),memory_budget // max(1,4*len(rows))))
+	found_a = []
+	found_b = []
+	for start in range(0,len(rows),block_size):
+		block_rows = rows[start:start+block_size]
+		other_rows = rows[start:]
+		block = np.asarray(matrix[block_rows],dtype=np.float32)
+		others = block if len(other_rows) == len(block_rows) else np.asarray(matrix[other_rows],dtype=np.float32)
+		sims = block.dot(others.T)
+		# only compare each row with the rows that follow it
+		sims[np.tril_indices(len(block_rows),0,len(other_rows))] = -np.inf
+		(i,j) = np.nonzero(sims >= threshold)
+		found_a.append(block_rows[i])
+		found_b.append(other_rows[j])
+	if not found_a:
+		return (np.zeros((0,),dtype=np.int64),np.zeros((0,),dtype=np.int64))
+	return (np.concatenate(found_a),np.concatenate(found_b))
+
+def lsh_split(matrix,rows,bits,rng,chunk_size=65536):
+	# hash the given rows of matrix using the signs of their projections onto bits random hyperplanes through
+	# the rows' (sample) mean - embeddings are typically non-negative, so hyperplanes through the origin would
+	# put most rows on the same side - returns a list of arrays of row indices, one for each bucket
+	sample = rows[np.sort(rng.choice(len(rows),min(len(rows),20000),replace=False))]
+	mean = np.asarray(matrix[sample],dtype=np.float32).mean(axis=0)
+	planes = rng.standard_normal((matrix.shape[1],bits)).astype(np.float32)
+	weights = (1 << np.arange(bits,dtype=np.int64))
+	keys = np.zeros((len(rows),),dtype=np.int64)
+	for start in range(0,len(rows),chunk_size):
+		chunk = np.asarray(matrix[rows[start:start+chunk_size]],dtype=np.float32) - mean
+		keys[start:start+len(chunk)] = (chunk.dot(planes) > 0).astype(np.int64).dot(weights)
+	order = np.argsort(keys,kind="stable")
+	boundaries = np.nonzero(np.diff(keys[order]))[0]+1
+	return np.split(rows[order],boundaries)
+
+def lsh_buckets(matrix,bits,seed=0,bucket_size=None,chunk_size=65536):
+	# hash each row of matrix to a bucket using bits random hyperplanes, rows with similar directions are
+	# likely to share a bucket, buckets holding more than bucket_size rows are split again using further
+	# hyperplanes through the bucket's mean, returns a list of arrays of row indices for each bucket
+	# containing more than one row
+	rng = np.random.RandomState(seed)
+	buckets = []
+	pending = [(np.arange(len(matrix)),bits)]
+	while pending:
+		(rows,rows_bits) = pending.pop()
+		for bucket in lsh_split(matrix,rows,rows_bits,rng,chunk_size):
+			if bucket_size and len(bucket) > bucket_size and len(bucket) < len(rows):
+				pending.append((bucket,max(1,int(math.ceil(math.log2(len(bucket)/bucket_size))))))
+			elif len(bucket) > 1:
+				# a bucket that could not be split (its rows are all near duplicates) is compared exhaustively
+				buckets.append(bucket)
+	return buckets
+
+def connected_components(count,a,b):
+	# label the connected components of the graph on count nodes with edges (a[i],b[i]), each node is
+	# labelled with the smallest node index in its component
+	labels = np.arange(count)
+	while True:
+		updated = labels.copy()
+		smallest = np.minimum(labels[a],labels[b])
+		np.minimum.at(updated,a,smallest)
+		np.minimum.at(updated,b,smallest)
+		while True:
+			jumped = updated[updated]
+			if np.array_equal(jumped,updated):
+				break
+			updated = jumped
+		if np.array_equal(updated,labels):
+			return labels
+		labels = updated
+
+def find_duplicate_groups(matrix,threshold=0.95,method=METHOD_AUTO,tables=8,bucket_size=1000,progress_cb=None):
+	# find groups of rows of (normalized) matrix connected by similarities >= threshold
+	# METHOD_EXACT compares all pairs of rows, METHOD_LSH only compares rows sharing a bucket in any of
+	# tables random hyperplane hash tables, with buckets of more than bucket_size rows split further - this may
+	# miss some pairs, more tables improve recall at the cost of speed
+	# returns a list of groups, each a sorted array of row indices, largest groups first
+	count = len(matrix)
+	if method == METHOD_AUTO:
+		method = METHOD_EXACT if count <= EXACT_MAX_ROWS else METHOD_LSH
+	if method == METHOD_EXACT:
+		(a,b) = similar_pairs(matrix,threshold)
+	elif method == METHOD_LSH:
+		bits = max(1,int(math.ceil(math.log2(max(1,count/bucket_size)))))
+		pairs = []
+		for table in range(tables):
+			for bucket in lsh_buckets(matrix,bits,seed=table,bucket_size=bucket_size):
+				(a,b) = similar_pairs(matrix,threshold,bucket)
+				pairs.append(np.unique(np.minimum(a,b)*count+np.maximum(a,b)))
+			if progress_cb:
+				progress_cb("Searched %d of %d hash tables"%(table+1,tables))
+		keys = np.unique(np.concatenate(pairs)) if pairs else np.zeros((0,),dtype=np.int64)
+		(a,b) = (keys // count, keys % count)
+	else:
+		raise Exception("Unknown duplicate search method: "+method)
+	if not len(a):
+		return []
+	labels = connected_components(count,a,b)
+	rows = np.unique(np.concatenate([a,b]))
+	order = np.argsort(labels[rows],kind="stable")
+	boundaries = np.nonzero(np.diff(labels[rows][order]))[0]+1
+	groups = np.split(rows[order],boundaries)
+	groups.sort(key=lambda group:-len(group))
+	return groups
@@ -0,0 +1,114 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import time
+import numpy as np
+
+from crocodl.runtime.connection_pool import ConnectionPool
+
+class EmbeddingCache(object):
+	"""
+	A persistent cache of embeddings (and thumbnails) keyed by model architecture and image content hash,
+	shared by any number of image stores and load jobs, so that images which have been embedded before are
+	not embedded again.
+
+	The cache is an SQLite database limited to max_size bytes of embeddings and thumbnails, the least
+	recently used entries are evicted when it grows beyond that.
+	"""
+
+	DEFAULT_MAX_SIZE = 1024*1024*1024
+
+	def __init__(self,path,max_size=DEFAULT_MAX_SIZE):
+		self.path = path
+		self.max_size = max_size
+		self.connections = ConnectionPool.getPool(path)
+		db = self.connections.get()
+		cursor = db.cursor()
+		cursor.execute("create table if not exists cache(architecture string, content_hash string, embedding blob, thumbnail blob, size integer, last_used real, primary key(architecture, content_hash))")
+		cursor.execute("create index if not exists cache_last_used on cache(last_used)")
+		cursor.execute("create table if not exists metadata(name string primary key, value string)")
+		db.commit()
+
+	def getTotalSize(self,cursor):
+		cursor.execute("select value from metadata where name = 'total_size'")
+		for row in cursor.fetchall():
+			return int(row[0])
+		return 0
+
+	def setTotalSize(self,total_size,cursor):
+		cursor.execute("insert or replace into metadata values('total_size',?)",(str(total_size),))
+
+	def get(self,architecture,content_hash):
+		# return the cached (embedding,thumbnail) for an image or None, does not update the entry's last use
+		# (see touch) so that it can be called concurrently from pipeline workers without writing
+		db = self.connections.get()
+		cursor = db.cursor()
+		cursor.execute("select embedding, thumbnail from cache where architecture = ? and content_hash = ?",
+					   (architecture,content_hash))
+		for (embedding,thumbnail) in cursor.fetchall():
+			return (np.frombuffer(embedding,dtype=np.float32),thumbnail)
+		return None
+
+	def touch(self,architecture,content_hashes):
+		# record the use of cached entries
+		db = self.connections.get()
+		now = time.time()
+		db.executemany("update cache set last_used = ? where architecture = ? and content_hash = ?",
+					   [(now,architecture,content_hash) for content_hash in content_hashes])
+		db.commit()
+
+	def put(self,architecture,entries):
+		# add a list of (content_hash,embedding,thumbnail) entries, then evict entries if the cache is too large
+		db = self.connections.get()
+		cursor = db.cursor()
+		now = time.time()
+		# take the write lock before reading the total size, so that concurrent load jobs sharing the cache
+		# cannot interleave their updates (sqlite3 would otherwise only begin the transaction at the insert)
+		cursor.execute("begin immediate")
+		try:
+			total_size = self.getTotalSize(cursor)
+			for (content_hash,embedding,thumbnail) in entries:
+				embedding = np.asarray(embedding,dtype=np.float32).tobytes()
+				cursor.execute("select size from cache where architecture = ? and content_hash = ?",(architecture,content_hash))
+				for (size,) in cursor.fetchall():
+					total_size -= size
+				size = len(embedding) + len(thumbnail)
+				cursor.execute("insert or replace into cache values(?,?,?,?,?,?)",
+							   (architecture,content_hash,embedding,thumbnail,size,now))
+				total_size += size
+			total_size = self.evict(cursor,total_size)
+			self.setTotalSize(total_size,cursor)
+			db.commit()
+		except:
+			db.rollback()
+			raise
+
+	def evict(self,cursor,total_size):
+		# remove the least recently used entries until the cache fits within max_size
+		while total_size > self.max_size:
+			cursor.execute("select architecture, content_hash, size from cache order by last_used limit 1000")
+			rows = cursor.fetchall()
+			if not rows:
+				return 0
+			evicted = []
+			for (architecture,content_hash,size) in rows:
+				evicted.append((architecture,content_hash))
+				total_size -= size
+				if total_size <= self.max_size:
+					break
+			cursor.executemany("delete from cache where architecture = ? and content_hash = ?",evicted)
+		return total_size
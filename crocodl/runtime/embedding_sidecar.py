@@ -0,0 +1,185 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import os.path
+import json
+import numpy as np
+
+from crocodl.runtime.compact_matrix import CompactMatrix
+
+class EmbeddingSidecar(object):
+	"""
+	Maintain a copy of an image store's (normalized) embeddings as a raw N x D matrix file next to the
+	database so that searches can memory map it rather than reading every row from SQLite.
+
+	The matrix is stored in the store's precision (see CompactMatrix): float32, float16 or int8 codes.
+
+	The sidecar consists of three files:
+		<db>.vectors       - the raw matrix
+		<db>.vectors.paths - the image path for each row, one JSON encoded string per line
+		<db>.vectors.json  - a header recording the row count, dimension, precision (and int8 scale and offset)
+		                     and the store generation it reflects
+	"""
+
+	# refit the int8 quantization once the sidecar holds at least this many rows and has grown by
+	# REQUANTIZE_GROWTH since the quantization was fitted (a new store starts with the default range [-1,1])
+	REQUANTIZE_ROWS = 1000
+	REQUANTIZE_GROWTH = 4
+
+	def __init__(self,db_path):
+		self.data_path = db_path + ".vectors"
+		self.paths_path = db_path + ".vectors.paths"
+		self.header_path = db_path + ".vectors.json"
+		self.rows = None
+
+	def getFilePaths(self):
+		return [self.data_path,self.paths_path,self.header_path]
+
+	def remove(self):
+		for path in self.getFilePaths():
+			if os.path.exists(path):
+				os.unlink(path)
+		self.rows = None
+
+	def readHeader(self):
+		try:
+			with open(self.header_path,"r") as f:
+				return json.loads(f.read())
+		except (OSError,ValueError):
+			return None
+
+	def writeHeader(self,header):
+		tmp_path = self.header_path + ".tmp"
+		with open(tmp_path,"w") as f:
+			f.write(json.dumps(header))
+		os.replace(tmp_path,self.header_path)
+
+	def isCurrent(self,store_id,generation):
+		header = self.readHeader()
+		return header is not None and header["store_id"] == store_id and header["generation"] == generation
+
+	def readPaths(self,count):
+		paths = []
+		with open(self.paths_path,"r",encoding="utf-8") as f:
+			for line in f:
+				if len(paths) == count:
+					break
+				paths.append(json.loads(line))
+		return paths
+
+	def load(self,store_id,generation):
+		# map the matrix read-only, returning (paths,matrix) or None if the sidecar is missing or out of date
+		matrix = self.loadMatrix(store_id,generation)
+		if matrix is None:
+			return None
+		try:
+			paths = self.readPaths(len(matrix))
+		except (OSError,ValueError):
+			return None
+		if len(paths) != len(matrix):
+			return None
+		return (paths,matrix)
+
+	def loadMatrix(self,store_id,generation):
+		# map just the matrix read-only (without reading the paths), or return None if the sidecar is missing or
+		# out of date
+		header = self.readHeader()
+		if header is None or header["store_id"] != store_id or header["generation"] != generation:
+			return None
+		count = header["count"]
+		dimension = header["dimension"]
+		precision = header.get("dtype",CompactMatrix.PRECISION_FLOAT32)
+		try:
+			dtype = CompactMatrix.getStorageDtype(precision)
+			if count == 0 or dimension == 0:
+				matrix = np.zeros((count,dimension),dtype=dtype)
+			else:
+				matrix = np.memmap(self.data_path,dtype=dtype,mode="r",shape=(count,dimension))
+		except (OSError,ValueError):
+			return None
+		if precision != CompactMatrix.PRECISION_FLOAT32:
+			(scale,offset) = self.getQuantization(header)
+			matrix = CompactMatrix(matrix,scale,offset)
+		return matrix
+
+	def getQuantization(self,header):
+		if "scale" not in header:
+			return (None,None)
+		return (np.array(header["scale"],dtype=np.float32),np.array(header["offset"],dtype=np.float32))
+
+	def rebuild(self,paths,matrix,store_id,generation,precision=CompactMatrix.PRECISION_FLOAT32):
+		# write a complete new sidecar, replacing the old files so that existing readers keep their mappings
+		matrix = np.asarray(matrix,dtype=np.float32)
+		header = {"store_id":store_id,"generation":generation,"dtype":precision,
+				  "count":len(paths),"dimension":matrix.shape[1]}
+		(scale,offset) = (None,None)
+		if precision == CompactMatrix.PRECISION_INT8 and matrix.shape[1]:
+			# the int8 quantization is fitted to the current embeddings, later updates are clipped to its range
+			(scale,offset) = CompactMatrix.fitQuantization(matrix)
+			header.update({"scale":scale.tolist(),"offset":offset.tolist(),"quantization_rows":len(matrix)})
+		with open(self.data_path + ".tmp","wb") as f:
+			f.write(CompactMatrix.encode(matrix,precision,scale,offset).tobytes())
+		with open(self.paths_path + ".tmp","w",encoding="utf-8") as f:
+			for path in paths:
+				f.write(json.dumps(path)+"\n")
+		os.replace(self.data_path + ".tmp",self.data_path)
+		os.replace(self.paths_path + ".tmp",self.paths_path)
+		self.writeHeader(header)
+		self.rows = {path:row for (row,path) in enumerate(paths)}
+
+	def needsRequantization(self):
+		# True if the int8 quantization was fitted to far fewer rows than the sidecar now holds
+		header = self.readHeader()
+		if header is None or header.get("dtype",None) != CompactMatrix.PRECISION_INT8:
+			return False
+		count = header["count"]
+		return count >= EmbeddingSidecar.REQUANTIZE_ROWS and \
+			count >= header.get("quantization_rows",0) * EmbeddingSidecar.REQUANTIZE_GROWTH
+
+	def update(self,embeddings,store_id,generation):
+		# write embeddings (a dict mapping path => vector) into the sidecar, overwriting rows for existing paths
+		# returns the row numbers that were written
+		header = self.readHeader()
+		count = header["count"]
+		dimension = header["dimension"]
+		precision = header.get("dtype",CompactMatrix.PRECISION_FLOAT32)
+		itemsize = np.dtype(CompactMatrix.getStorageDtype(precision)).itemsize
+		(scale,offset) = self.getQuantization(header)
+		if self.rows is None:
+			self.rows = {path:row for (row,path) in enumerate(self.readPaths(count))}
+		rows = []
+		with open(self.data_path,"r+b") as data_file, open(self.paths_path,"a",encoding="utf-8") as paths_file:
+			for (path,embedding) in embeddings.items():
+				vector = np.atleast_2d(np.asarray(embedding,dtype=np.float32))
+				if dimension == 0:
+					dimension = vector.shape[1]
+				if precision == CompactMatrix.PRECISION_INT8 and scale is None:
+					(scale,offset) = CompactMatrix.fitQuantization(np.zeros((0,dimension),dtype=np.float32))
+					header.update({"scale":scale.tolist(),"offset":offset.tolist(),"quantization_rows":0})
+				row = self.rows.get(path,None)
+				if row is None:
+					row = count
+					count += 1
+					self.rows[path] = row
+					paths_file.write(json.dumps(path)+"\n")
+				data_file.seek(row*dimension*itemsize)
+				data_file.write(CompactMatrix.encode(vector,precision,scale,offset).tobytes())
+				rows.append(row)
+		header.update({"store_id":store_id,"generation":generation,"count":count,"dimension":dimension})
+		self.writeHeader(header)
+		return rows
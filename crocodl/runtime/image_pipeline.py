@@ -0,0 +1,93 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class ImagePipeline(object):
+	"""
+	Run a function over a sequence of items (for example, decoding and resizing image files) using a pool
+	of worker threads, so that the work overlaps with whatever the consumer of the results is doing.
+
+	At most queue_depth items are in flight at any time and results are returned in the order of the items.
+	"""
+
+	def __init__(self,fn,workers=4,queue_depth=64):
+		self.fn = fn
+		self.workers = max(1,workers)
+		self.queue_depth = max(1,queue_depth)
+		self.busy_seconds = 0.0
+		self.wait_seconds = 0.0
+		self.lock = threading.Lock()
+
+	def timed(self,item):
+		start = time.time()
+		try:
+			return self.fn(item)
+		finally:
+			with self.lock:
+				self.busy_seconds += time.time() - start
+
+	def run(self,items):
+		# generator yielding (item,result,exception) for each item, exception is None if fn succeeded
+		# an exception raised by the items iterator is re-raised by the generator once the preceding items
+		# have been yielded
+		futures = queue.Queue(maxsize=self.queue_depth)
+		stop = threading.Event()
+		feed_exceptions = []
+		with ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+			def feed():
+				try:
+					for item in items:
+						if stop.is_set():
+							break
+						futures.put((item,executor.submit(self.timed,item)))
+				except Exception as ex:
+					feed_exceptions.append(ex)
+				finally:
+					futures.put(None)
+
+			feeder = threading.Thread(target=feed,daemon=True)
+			feeder.start()
+			try:
+				while True:
+					start = time.time()
+					entry = futures.get()
+					if entry is None:
+						if feed_exceptions:
+							raise feed_exceptions[0]
+						break
+					(item,future) = entry
+					try:
+						result = future.result()
+						exception = None
+					except Exception as ex:
+						result = None
+						exception = ex
+					self.wait_seconds += time.time() - start
+					yield (item,result,exception)
+			finally:
+				# if the consumer stops early, drain the queue so that the feeder can finish
+				stop.set()
+				while feeder.is_alive():
+					try:
+						futures.get(timeout=0.1)
+					except queue.Empty:
+						pass
@@ -15,48 +15,296 @@
 #   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 #   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import sqlite3
+import os
+import os.path
 import json
-import math
+import uuid
+import base64
+import numpy as np
 from crocodl.runtime.image_utils import ImageUtils
+from crocodl.runtime.search_engine import SearchEngine
+from crocodl.runtime.embedding_sidecar import EmbeddingSidecar
+from crocodl.runtime.ivf_index import IVFIndex
+from crocodl.runtime.pq_index import PQIndex
+from crocodl.runtime.binary_index import BinaryIndex
+from crocodl.runtime.coarse_index import CoarseIndex
+from crocodl.runtime.load_journal import LoadJournal
+from crocodl.runtime.projection import Projection
+from crocodl.runtime.connection_pool import ConnectionPool
+from crocodl.runtime.compact_matrix import CompactMatrix
+from crocodl.runtime.duplicate_finder import find_duplicate_groups, METHOD_AUTO
+from crocodl.runtime.search_benchmark import benchmark
 
 class ImageStore(object):
 
+	# version 1 - embeddings stored as JSON encoded text
+	# version 2 - embeddings stored as raw binary blobs, dtype and dimension recorded in the metadata table
+	# version 3 - content hash, size and modification time of the source image file recorded for each embedding
+	# version 4 - thumbnails moved from the embeddings table to the thumbnails table, stored as raw JPEG bytes
+	# version 5 - embeddings stored normalized to unit length, with their original length in the norm column
+	FORMAT_VERSION = 5
+
+	DEFAULT_DTYPE = "float32"
+
+	INDEX_IVF = "ivf"
+	INDEX_PQ = "pq"
+	INDEX_BINARY = "binary"
+	INDEX_COARSE = "coarse"
+
+	INDEX_CLASSES = {INDEX_IVF:IVFIndex, INDEX_PQ:PQIndex, INDEX_BINARY:BinaryIndex, INDEX_COARSE:CoarseIndex}
+
+	# the projection applied to embeddings before they are stored or searched
+	PROJECTION_STORE = "store"
+
 	def __init__(self,path="image_embeddings.db"):
 		self.path = path
-		db = sqlite3.connect(path)
+		self.connections = ConnectionPool.getPool(path)
+		db = self.connections.get()
 		cursor = db.cursor()
-		cursor.execute("create table if not exists embeddings(path string primary key,search string, thumbnail string)")
+		cursor.execute("create table if not exists embeddings(path string primary key,search string, content_hash string, size integer, mtime real, norm real)")
+		cursor.execute("create table if not exists thumbnails(path string primary key, image blob)")
 		cursor.execute("create table if not exists architecture(name string)")
+		cursor.execute("create table if not exists metadata(name string primary key, value string)")
+		cursor.execute("create table if not exists projections(name string primary key, weights blob, bias blob, input_dimension integer, output_dimension integer)")
+		cursor.execute("create table if not exists duplicates(path string primary key, group_id integer)")
+		cursor.execute("create table if not exists tags(path string, tag string, primary key(path,tag))")
+		cursor.execute("create index if not exists tags_tag on tags(tag)")
+		cursor.execute("create index if not exists duplicates_group_id on duplicates(group_id)")
 		db.commit()
 		self.uncommitted_count = 0
 		self.db = None
 		self.cursor = None
+		self.engine = None
+		self.engine_generation = None
+		self.query_projection = None
+		self.projection = None
+		self.pending = {}
+		self.sidecar = EmbeddingSidecar(path)
+		self.indexes = {name:cls(path) for (name,cls) in ImageStore.INDEX_CLASSES.items()}
+		if self.getMetadata("store_id",None,cursor) is None:
+			self.setMetadata("store_id",uuid.uuid4().hex,cursor)
+			db.commit()
+		self.migrate(db)
+
+	@staticmethod
+	def delete(path):
+		# remove an image store database, its sidecar files and its load journal
+		ConnectionPool.closePool(path)
+		for db_path in [path,path+"-wal",path+"-shm"]:
+			if os.path.exists(db_path):
+				os.unlink(db_path)
+		EmbeddingSidecar(path).remove()
+		for cls in ImageStore.INDEX_CLASSES.values():
+			cls(path).remove()
+		LoadJournal(path).remove()
+
+	def migrate(self,db):
+		# one-time upgrade of stores created with earlier format versions
+		cursor = db.cursor()
+		format_version = int(self.getMetadata("format_version",1,cursor))
+		if format_version >= ImageStore.FORMAT_VERSION:
+			return
+		if format_version < 2:
+			self.migrateBinaryEmbeddings(db)
+		if format_version < 3:
+			columns = [row[1] for row in cursor.execute("pragma table_info(embeddings)").fetchall()]
+			for (column,column_type) in [("content_hash","string"),("size","integer"),("mtime","real")]:
+				if column not in columns:
+					cursor.execute("alter table embeddings add column %s %s"%(column,column_type))
+		if format_version < 4:
+			self.migrateThumbnails(db)
+		if format_version < 5:
+			self.migrateNormalizedEmbeddings(db)
+		self.setMetadata("format_version",ImageStore.FORMAT_VERSION,cursor)
+		db.commit()
+		if format_version < 4:
+			# reclaim the space used by the base64 thumbnails
+			db.execute("vacuum")
+
+	def migrateThumbnails(self,db):
+		# move base64 encoded thumbnails from the embeddings table to the thumbnails table as raw bytes
+		cursor = db.cursor()
+		columns = [row[1] for row in cursor.execute("pragma table_info(embeddings)").fetchall()]
+		if "thumbnail" not in columns:
+			return
+		read_cursor = db.cursor()
+		read_cursor.execute("select path, thumbnail from embeddings where thumbnail is not null")
+		while True:
+			rows = read_cursor.fetchmany(1000)
+			if not rows:
+				break
+			cursor.executemany("insert or replace into thumbnails values(?,?)",
+							   [(path,base64.b64decode(thumbnail)) for (path,thumbnail) in rows])
+		cursor.execute("create table embeddings_v4(path string primary key,search string, content_hash string, size integer, mtime real)")
+		cursor.execute("insert into embeddings_v4 select path, search, content_hash, size, mtime from embeddings")
+		cursor.execute("drop table embeddings")
+		cursor.execute("alter table embeddings_v4 rename to embeddings")
+
+	def migrateNormalizedEmbeddings(self,db):
+		# rewrite each embedding normalized to unit length, recording its original length
+		cursor = db.cursor()
+		columns = [row[1] for row in cursor.execute("pragma table_info(embeddings)").fetchall()]
+		if "norm" not in columns:
+			cursor.execute("alter table embeddings add column norm real")
+		dtype = np.dtype(self.getMetadata("embedding_dtype",ImageStore.DEFAULT_DTYPE,cursor))
+		read_cursor = db.cursor()
+		read_cursor.execute("select path, search from embeddings where norm is null")
+		rewritten = False
+		while True:
+			rows = read_cursor.fetchmany(1000)
+			if not rows:
+				break
+			matrix = np.array([self.decodeEmbedding(search,dtype) for (_,search) in rows],dtype=np.float32)
+			norms = np.linalg.norm(matrix,axis=1)
+			matrix = SearchEngine.normalize(matrix)
+			cursor.executemany("update embeddings set search = ?, norm = ? where path = ?",
+				[(matrix[idx].astype(dtype).tobytes(),float(norms[idx]),path) for (idx,(path,_)) in enumerate(rows)])
+			rewritten = True
+		if rewritten:
+			# the sidecar and indexes are rebuilt from the rewritten embeddings
+			self.bumpGeneration(cursor)
+
+	def migrateBinaryEmbeddings(self,db):
+		# conversion of JSON encoded embeddings (format version 1) to binary blobs
+		cursor = db.cursor()
+		dtype = np.dtype(self.getMetadata("embedding_dtype",ImageStore.DEFAULT_DTYPE,cursor))
+		dimension = self.getMetadata("embedding_dimension",None,cursor)
+		read_cursor = db.cursor()
+		read_cursor.execute("select path, search from embeddings where typeof(search) = 'text'")
+		while True:
+			rows = read_cursor.fetchmany(1000)
+			if not rows:
+				break
+			updates = []
+			for (path,search) in rows:
+				embedding = np.asarray(json.loads(search),dtype=dtype)
+				if dimension is None:
+					dimension = len(embedding)
+				updates.append((embedding.tobytes(),path))
+			cursor.executemany("update embeddings set search = ? where path = ?",updates)
+		self.setMetadata("embedding_dtype",dtype.name,cursor)
+		if dimension is not None:
+			self.setMetadata("embedding_dimension",dimension,cursor)
+
+	def getMetadata(self,name,default_value=None,cursor=None):
+		if cursor is None:
+			db = self.connections.get()
+			cursor = db.cursor()
+		cursor.execute("select value from metadata where name = ?",(name,))
+		for row in cursor.fetchall():
+			return row[0]
+		return default_value
+
+	def setMetadata(self,name,value,cursor=None):
+		db = None
+		if cursor is None:
+			db = self.connections.get()
+			cursor = db.cursor()
+		cursor.execute("insert or replace into metadata values(?,?)",(name,str(value)))
+		if db:
+			db.commit()
+
+	def getStoreId(self):
+		return self.getMetadata("store_id",None,self.cursor)
+
+	def getGeneration(self):
+		# the generation is incremented whenever the contents of the store are modified
+		return int(self.getMetadata("generation",0,self.cursor))
+
+	def bumpGeneration(self,cursor):
+		generation = int(self.getMetadata("generation",0,cursor)) + 1
+		self.setMetadata("generation",generation,cursor)
+		return generation
+
+	def getEmbeddingDtype(self):
+		return np.dtype(self.getMetadata("embedding_dtype",ImageStore.DEFAULT_DTYPE,self.cursor))
+
+	def getEmbeddingDimension(self):
+		dimension = self.getMetadata("embedding_dimension",None,self.cursor)
+		return int(dimension) if dimension is not None else None
+
+	def encodeEmbedding(self,embedding):
+		return self.checkEmbedding(embedding).tobytes()
+
+	def checkEmbedding(self,embedding):
+		arr = np.asarray(embedding,dtype=self.dtype)
+		if self.dimension is None:
+			self.dimension = len(arr)
+			self.setMetadata("embedding_dimension",self.dimension,self.cursor)
+		elif len(arr) != self.dimension:
+			raise Exception("Embedding dimension %d does not match image store dimension %d"%(len(arr),self.dimension))
+		return arr
+
+	def decodeEmbedding(self,value,dtype=None):
+		if isinstance(value,str):
+			# legacy (format version 1) JSON encoded embedding
+			return np.asarray(json.loads(value),dtype=np.float32)
+		if dtype is None:
+			dtype = self.getEmbeddingDtype()
+		return np.frombuffer(value,dtype=dtype).astype(np.float32)
 
 	def __len__(self):
 		if self.cursor:
 			cursor = self.cursor
 		else:
-			db = sqlite3.connect(self.path)
+			db = self.connections.get()
 			cursor = db.cursor()
 		cursor.execute("select count(*) from embeddings")
 		return cursor.fetchone()[0]
 
 	def clear(self):
-		db = sqlite3.connect(self.path)
+		db = self.connections.get()
 		cursor = db.cursor()
 		cursor.execute("delete from embeddings")
+		cursor.execute("delete from thumbnails")
+		cursor.execute("delete from duplicates")
+		cursor.execute("delete from tags")
+		generation = self.bumpGeneration(cursor)
 		db.commit()
+		self.sidecar.rebuild([],np.zeros((0,0),dtype=np.float32),self.getStoreId(),generation,self.getPrecision())
+		for index in self.indexes.values():
+			index.remove()
+		self.engine = None
 
-	def setArchitecture(self,architecture):
-		db = sqlite3.connect(self.path)
+	def setArchitecture(self,architecture,precision=None):
+		# precision, if specified, sets the precision of the stored embeddings (see setPrecision)
+		db = self.connections.get()
 		cursor = db.cursor()
 		cursor.execute("delete from architecture")
 		cursor.execute("insert into architecture values(?)", (architecture,))
 		db.commit()
+		if precision is not None and precision != self.getPrecision():
+			self.setPrecision(precision)
+
+	def getPrecision(self):
+		return self.getMetadata("embedding_precision",CompactMatrix.PRECISION_FLOAT32,self.cursor)
+
+	def setPrecision(self,precision):
+		# set the precision (a CompactMatrix precision) used to scan the store's embeddings: float16 and int8
+		# (with a per-dimension scale and offset) sidecars use a half or quarter of the memory of float32 and
+		# searches re-rank their best candidates using the stored vectors, which are kept as float16
+		if precision not in CompactMatrix.PRECISIONS:
+			raise Exception("Unsupported embedding precision: "+str(precision))
+		dtype = np.dtype(np.float32 if precision == CompactMatrix.PRECISION_FLOAT32 else np.float16)
+		(paths,matrix) = self.loadEmbeddings()
+		db = self.connections.get()
+		cursor = db.cursor()
+		if dtype != self.getEmbeddingDtype():
+			for start in range(0,len(paths),1000):
+				cursor.executemany("update embeddings set search = ? where path = ?",
+					[(matrix[idx].astype(dtype).tobytes(),paths[idx]) for idx in range(start,min(start+1000,len(paths)))])
+			self.setMetadata("embedding_dtype",dtype.name,cursor)
+		self.setMetadata("embedding_precision",precision,cursor)
+		generation = self.bumpGeneration(cursor)
+		db.commit()
+		self.sidecar.rebuild(paths,matrix,self.getStoreId(),generation,precision)
+		for index in self.indexes.values():
+			index.remove()
+		self.updateIndexes()
+		self.engine = None
 
 	def getArchitecture(self):
-		db = sqlite3.connect(self.path)
+		db = self.connections.get()
 		cursor = db.cursor()
 		cursor.execute("select * from architecture")
 		for row in cursor.fetchall():
@@ -67,21 +315,230 @@ class ImageStore(object):
 		return len(self) == 0
 
 	def open(self):
-		self.db = sqlite3.connect(self.path)
+		# the loader uses its own connection, so that other users of the pool on this thread do not
+		# commit its transaction
+		self.db = self.connections.connect()
 		self.cursor = self.db.cursor()
+		self.dtype = self.getEmbeddingDtype()
+		self.dimension = self.getEmbeddingDimension()
+		self.projection = self.getProjection()
+		self.pending = {}
+		self.pending_rows = []
+		self.syncSidecar()
+
+	def syncSidecar(self):
+		# rebuild the sidecar from the database if it is missing or does not reflect the current generation
+		store_id = self.getStoreId()
+		generation = self.getGeneration()
+		if not self.sidecar.isCurrent(store_id,generation):
+			(paths,matrix) = self.loadEmbeddings()
+			self.sidecar.rebuild(paths,matrix,store_id,generation,self.getPrecision())
+		self.requantize()
+
+	def requantize(self):
+		# an int8 sidecar's quantization is fitted to the embeddings it was built from, a store created empty starts
+		# with the default range [-1,1] - refit it (rebuilding the sidecar and indexes) once the store has grown
+		if not self.sidecar.needsRequantization():
+			return
+		(paths,matrix) = self.loadEmbeddings()
+		db = self.connections.get()
+		cursor = db.cursor()
+		generation = self.bumpGeneration(cursor)
+		db.commit()
+		self.sidecar.rebuild(paths,matrix,self.getStoreId(),generation,self.getPrecision())
+		self.updateIndexes()
+		self.engine = None
 
 	def addEmbedding(self,path,embedding,image):
-		embedding_enc = json.dumps(embedding)
-		self.cursor.execute("insert or replace into embeddings values(?,?,?)",(path,embedding_enc,ImageUtils.encodeThumbnail(image)))
-		self.uncommitted_count += 1
+		self.insertEmbedding(path,embedding,image)
 		if self.uncommitted_count > 50:
+			self.commit()
+
+	def addEmbeddings(self,embeddings):
+		# add a batch of (path,embedding,image) or (path,embedding,image,file_info) tuples in a single transaction
+		# image may be a thumbnail already encoded using ImageUtils.encodeThumbnailBytes
+		# file_info is a (content_hash,size,mtime) tuple describing the source image file
+		for entry in embeddings:
+			self.insertEmbedding(*entry)
+		self.commit()
+
+	def insertEmbedding(self,path,embedding,image,file_info=(None,None,None)):
+		if self.projection:
+			embedding = self.projection.apply(embedding)
+		arr = self.checkEmbedding(embedding)
+		# embeddings are stored normalized so that searches need only compute inner products
+		# (normalized in a copy, as the caller may go on to use the original embedding)
+		vector = np.array(arr,dtype=np.float32)
+		norm = float(np.linalg.norm(vector))
+		arr = SearchEngine.normalize(vector)[0].astype(self.dtype)
+		thumbnail = image if isinstance(image,bytes) else ImageUtils.encodeThumbnailBytes(image)
+		(content_hash,size,mtime) = file_info
+		self.pending_rows.append((path,arr.tobytes(),content_hash,size,mtime,norm,thumbnail))
+		self.pending[path] = arr
+		self.uncommitted_count += 1
+
+	def commit(self):
+		# commit to the database first, the sidecar is then updated to the new generation
+		if self.pending_rows:
+			self.cursor.executemany("insert or replace into embeddings(path,search,content_hash,size,mtime,norm) values(?,?,?,?,?,?)",
+									[row[:6] for row in self.pending_rows])
+			self.cursor.executemany("insert or replace into thumbnails values(?,?)",
+									[(row[0],row[6]) for row in self.pending_rows])
+			self.pending_rows = []
+		if not self.pending:
 			self.db.commit()
-			self.uncommitted_count = 0
+			return
+		generation = self.bumpGeneration(self.cursor)
+		self.db.commit()
+		rows = self.sidecar.update(self.pending,self.getStoreId(),generation)
+		self.pending = {}
+		self.uncommitted_count = 0
+		self.updateIndexes(rows,generation-1)
 
-	def close(self):
+	def getProjection(self,name=PROJECTION_STORE):
+		db = self.connections.get()
+		cursor = db.cursor()
+		cursor.execute("select weights, bias, input_dimension, output_dimension from projections where name = ?",(name,))
+		for (weights,bias,input_dimension,output_dimension) in cursor.fetchall():
+			return Projection(np.frombuffer(weights,dtype=np.float32).reshape(output_dimension,input_dimension),
+							  np.frombuffer(bias,dtype=np.float32))
+		return None
+
+	def setProjection(self,projection,name,cursor):
+		cursor.execute("insert or replace into projections values(?,?,?,?,?)",(name,projection.weights.tobytes(),
+			projection.bias.tobytes(),projection.getInputDimension(),projection.getOutputDimension()))
+
+	def fitProjection(self,dimension,whiten=False):
+		# fit a PCA projection (optionally whitened) to the stored embeddings and rewrite them in the reduced
+		# dimension, the projection is then applied to new embeddings and to queries
+		(paths,matrix) = self.loadEmbeddings(original=True)
+		if not paths:
+			raise Exception("Cannot fit a projection to an empty image store")
+		return self.applyProjection(Projection.fitPCA(matrix,dimension,whiten),paths,matrix)
+
+	def applyProjection(self,pca,paths=None,matrix=None):
+		# rewrite the stored embeddings using a projection fitted elsewhere (for example to the embeddings of
+		# all the shards of a sharded store), the projection is then applied to new embeddings and to queries
+		# matrix, if specified, holds the original (not normalized) embeddings
+		if paths is None:
+			(paths,matrix) = self.loadEmbeddings(original=True)
+		existing = self.getProjection()
+		projection = existing.then(pca) if existing else pca
+		projected = pca.apply(matrix) if len(paths) else np.zeros((0,pca.getOutputDimension()),dtype=np.float32)
+		norms = np.linalg.norm(projected,axis=1)
+		projected = SearchEngine.normalize(projected)
+		dtype = self.getEmbeddingDtype()
+		db = self.connections.get()
+		cursor = db.cursor()
+		for start in range(0,len(paths),1000):
+			cursor.executemany("update embeddings set search = ?, norm = ? where path = ?",
+				[(projected[idx].astype(dtype).tobytes(),float(norms[idx]),paths[idx])
+				 for idx in range(start,min(start+1000,len(paths)))])
+		self.setProjection(projection,ImageStore.PROJECTION_STORE,cursor)
+		self.setMetadata("embedding_dimension",projection.getOutputDimension(),cursor)
+		generation = self.bumpGeneration(cursor)
+		db.commit()
+		self.sidecar.rebuild(paths,projected,self.getStoreId(),generation,self.getPrecision())
+		for index in self.indexes.values():
+			index.remove()
+		self.updateIndexes()
+		return projection
+
+	def setIndexes(self,indexes):
+		# configure the indexes maintained for this store, as a dict mapping an index name (INDEX_IVF, INDEX_PQ,
+		# INDEX_BINARY, INDEX_COARSE) to its setting (the number of IVF lists, PQ sub-quantizers, binary code bits
+		# or coarse dimensions, None to choose automatically)
+		self.setMetadata("indexes",json.dumps(indexes),self.cursor)
+		if self.db:
+			self.db.commit()
+		for (name,index) in self.indexes.items():
+			if name not in indexes:
+				index.remove()
+		self.updateIndexes()
+		# the generation is unchanged, so discard the search engine to pick up the new indexes
+		self.engine = None
+
+	def getIndexes(self):
+		return json.loads(self.getMetadata("indexes","{}",self.cursor))
+
+	def updateIndexes(self,rows=(),previous_generation=None):
+		# bring the configured indexes up to date with the sidecar, training each when the store is large enough
+		indexes = self.getIndexes()
+		if not indexes:
+			return
+		store_id = self.getStoreId()
+		generation = self.getGeneration()
+		matrix = self.sidecar.loadMatrix(store_id,generation)
+		if matrix is None:
+			return
+		for (name,setting) in indexes.items():
+			index = self.indexes[name]
+			if not index.isTrained():
+				index.load()
+			if index.needsTraining(len(matrix)):
+				index.train(matrix,store_id,generation,setting)
+			elif index.isCurrent(store_id,generation):
+				continue
+			elif index.isCurrent(store_id,previous_generation):
+				index.update(matrix,rows,store_id,generation)
+			elif index.isTrained():
+				index.reassign(matrix,store_id,generation)
+
+	def getFileInfo(self):
+		# return a dict mapping path => (content_hash,size,mtime) for embeddings with a recorded source file
+		db = self.connections.get()
+		cursor = db.cursor()
+		cursor.execute("select path, content_hash, size, mtime from embeddings where content_hash is not null")
+		return {path:(content_hash,size,mtime) for (path,content_hash,size,mtime) in cursor}
+
+	def updateFileInfo(self,file_infos):
+		# record new sizes and modification times for (path,(content_hash,size,mtime)) whose content is unchanged
+		self.cursor.executemany("update embeddings set size = ?, mtime = ? where path = ? and content_hash = ?",
+								[(size,mtime,path,content_hash) for (path,(content_hash,size,mtime)) in file_infos])
 		self.db.commit()
+
+	def findDuplicates(self,threshold=0.95,method=METHOD_AUTO,tables=8,bucket_size=1000,progress_cb=None):
+		# find groups of near-duplicate images, connected by similarities >= threshold, and record them in the
+		# duplicates table (see find_duplicate_groups for the methods)
+		# returns a list of groups, each a list of paths, largest groups first
+		engine = self.getSearchEngine()
+		groups = find_duplicate_groups(engine.matrix,threshold,method,tables,bucket_size,progress_cb)
+		groups = [sorted(engine.paths[row] for row in group) for group in groups]
+		self.setDuplicates(groups,threshold)
+		return groups
+
+	def setDuplicates(self,groups,threshold,group_ids=None):
+		db = self.connections.get()
+		cursor = db.cursor()
+		cursor.execute("delete from duplicates")
+		if group_ids is None:
+			group_ids = range(len(groups))
+		cursor.executemany("insert into duplicates values(?,?)",
+						   [(path,group_id) for (group_id,group) in zip(group_ids,groups) for path in group])
+		self.setMetadata("duplicates_threshold",threshold,cursor)
+		db.commit()
+
+	def getDuplicates(self):
+		# return the groups recorded by the last call to findDuplicates, as a dict mapping group id => list of paths
+		db = self.connections.get()
+		cursor = db.cursor()
+		groups = {}
+		for (path,group_id) in cursor.execute("select path, group_id from duplicates order by group_id, path"):
+			groups.setdefault(group_id,[]).append(path)
+		return groups
+
+	def close(self):
+		self.commit()
+		self.db.execute("pragma wal_checkpoint(PASSIVE)")
+		self.db.close()
 		self.cursor = None
 		self.db = None
+		self.requantize()
+
+	def checkpoint(self):
+		# copy all committed changes from the write-ahead log into the database file, for example before
+		# the database file is downloaded
+		self.connections.get().execute("pragma wal_checkpoint(TRUNCATE)")
 
 	def fetchAll(self,cursor):
 		cnames = [c[0] for c in cursor.description]
@@ -91,40 +548,163 @@ class ImageStore(object):
 		return rows
 
 	def fetchImage(self,path):
-		db = sqlite3.connect(self.path)
+		return self.fetchImages([path]).get(path,None)
+
+	def fetchImages(self,paths):
+		# fetch the thumbnails for a list of paths in a single query, returning a dict mapping path => image
+		db = self.connections.get()
 		cursor = db.cursor()
-		cursor.execute("select thumbnail from embeddings where path = ?",(path,))
-		for row in cursor.fetchall():
-			return ImageUtils.decodeThumbnail(row[0])
-		return None
+		images = {}
+		for start in range(0,len(paths),500):
+			chunk = paths[start:start+500]
+			cursor.execute("select path, image from thumbnails where path in (%s)"%(",".join("?"*len(chunk))),chunk)
+			for (path,image) in cursor.fetchall():
+				images[path] = ImageUtils.decodeThumbnailBytes(image)
+		return images
 
 	def distance(self,v1,v2):
-		# compute cosine similarity
-		dp = 0.0
-		A = 0.0
-		B = 0.0
-		v = zip(v1,v2)
-		for (e1,e2) in v:
-			dp += e1*e2
-			A += e1**2
-			B += e2**2
-
-		return dp / (math.sqrt(A) * math.sqrt(B))
-
-	def similaritySearch(self,embedding,firstN=3,progress_cb=None):
-		db = sqlite3.connect(self.path)
-		cursor = db.cursor()
-		distances = []
-		counter = 0
-		cursor.execute("select * from embeddings")
-		for row in self.fetchAll(cursor):
-			path = row["path"]
-			candidate = json.loads(row["search"])
-			d = self.distance(embedding,candidate)
-			distances.append((path,d))
-			distances = sorted(distances,key=lambda x:x[1],reverse=True)[:firstN]
-			counter += 1
-			if counter % 10 == 0:
-				if progress_cb:
-					progress_cb("Searched "+ str(counter) + " images")
-		return list(map(lambda x:(x[0],x[1],self.fetchImage(x[0])),distances))
\ No newline at end of file
+		# compute cosine similarity (stored embeddings are already normalized, so this is their inner product)
+		return float(SearchEngine.normalizeQuery(v1).dot(SearchEngine.normalizeQuery(v2)))
+
+	def loadEmbeddings(self,original=False):
+		# read all embeddings into a list of paths and a contiguous N x D float32 matrix
+		# the embeddings are normalized, unless original is True in which case each is scaled by its original length
+		db = self.connections.get()
+		cursor = db.cursor()
+		dtype = self.getEmbeddingDtype()
+		dimension = self.getEmbeddingDimension()
+		cursor.execute("select count(*) from embeddings")
+		count = cursor.fetchone()[0]
+		paths = []
+		matrix = np.zeros((count,dimension or 0),dtype=np.float32)
+		cursor.execute("select path, search, norm from embeddings")
+		for (path,search,norm) in cursor:
+			if len(paths) == count:
+				break
+			matrix[len(paths),:] = self.decodeEmbedding(search,dtype)
+			if original and norm is not None:
+				matrix[len(paths),:] *= norm
+			paths.append(path)
+		return paths, matrix[:len(paths)]
+
+	def loadVectors(self,paths):
+		# read the embeddings for a list of paths into a float32 matrix, in the same order
+		db = self.connections.get()
+		cursor = db.cursor()
+		dtype = self.getEmbeddingDtype()
+		vectors = {}
+		for start in range(0,len(paths),500):
+			chunk = paths[start:start+500]
+			cursor.execute("select path, search from embeddings where path in (%s)"%(",".join("?"*len(chunk))),chunk)
+			for (path,search) in cursor.fetchall():
+				vectors[path] = self.decodeEmbedding(search,dtype)
+		return np.array([vectors[path] for path in paths],dtype=np.float32).reshape(len(paths),-1)
+
+	def exportEmbeddings(self,chunk_size=1000):
+		# yield the stored images as lists of up to chunk_size (path,embedding,thumbnail,file_info) tuples, in the
+		# form accepted by addEmbeddings, each embedding scaled to its original length
+		db = self.connections.get()
+		cursor = db.cursor()
+		dtype = self.getEmbeddingDtype()
+		cursor.execute("select e.path, e.search, e.norm, t.image, e.content_hash, e.size, e.mtime "
+					   "from embeddings e left join thumbnails t on e.path = t.path")
+		while True:
+			rows = cursor.fetchmany(chunk_size)
+			if not rows:
+				break
+			yield [(path,self.decodeEmbedding(search,dtype)*(1.0 if norm is None else norm),thumbnail,
+					(content_hash,size,mtime)) for (path,search,norm,thumbnail,content_hash,size,mtime) in rows]
+
+	def getSearchEngine(self):
+		# use the memory mapped sidecar if it is up to date, otherwise fall back to reading the database
+		generation = self.getGeneration()
+		if self.engine is None or self.engine_generation != generation:
+			loaded = self.sidecar.load(self.getStoreId(),generation)
+			if loaded:
+				(paths,matrix) = loaded
+				indexes = {}
+				for name in self.getIndexes():
+					index = ImageStore.INDEX_CLASSES[name](self.path)
+					if index.load() and index.isCurrent(self.getStoreId(),generation):
+						indexes[name] = index
+				exact_vectors = self.loadVectors if isinstance(matrix,CompactMatrix) else None
+				self.engine = SearchEngine(paths,matrix,normalized=True,indexes=indexes,exact_vectors=exact_vectors)
+			else:
+				(paths,matrix) = self.loadEmbeddings()
+				self.engine = SearchEngine(paths,matrix,normalized=True)
+			self.engine_generation = generation
+			self.query_projection = self.getProjection()
+		return self.engine
+
+	def getFilteredPaths(self,filters):
+		# return the paths matching filters, a dict which may specify a path "prefix" and/or a list of "tags"
+		# (matching paths must have all of the tags), using the primary key and tag indexes
+		conditions = []
+		parameters = []
+		prefix = filters.get("prefix","")
+		if prefix:
+			conditions.append("path >= ? and path < ?")
+			parameters += [prefix,prefix[:-1]+chr(ord(prefix[-1])+1)]
+		tags = sorted(set(filters.get("tags",[])))
+		if tags:
+			conditions.append("path in (select path from tags where tag in (%s) group by path having count(*) = ?)"
+							  %(",".join("?"*len(tags))))
+			parameters += tags + [len(tags)]
+		db = self.connections.get()
+		cursor = db.cursor()
+		cursor.execute("select path from embeddings where "+(" and ".join(conditions) or "1"),parameters)
+		return [row[0] for row in cursor]
+
+	def setTags(self,path_tags):
+		# replace the tags of each (path,[tag,...]) in path_tags
+		if self.db:
+			(db,cursor) = (self.db,self.cursor)
+		else:
+			db = self.connections.get()
+			cursor = db.cursor()
+		cursor.executemany("delete from tags where path = ?",[(path,) for (path,_) in path_tags])
+		cursor.executemany("insert or ignore into tags values(?,?)",[(path,tag) for (path,tags) in path_tags for tag in tags])
+		# filtered search results change with the tags, so start a new generation (the embeddings are unchanged)
+		generation = self.bumpGeneration(cursor)
+		db.commit()
+		if self.sidecar.isCurrent(self.getStoreId(),generation-1):
+			self.sidecar.update({},self.getStoreId(),generation)
+			self.updateIndexes([],generation-1)
+
+	def getTags(self,path):
+		db = self.connections.get()
+		cursor = db.cursor()
+		cursor.execute("select tag from tags where path = ? order by tag",(path,))
+		return [row[0] for row in cursor]
+
+	def rankedSearch(self,embedding,firstN=3,mode=SearchEngine.MODE_EXACT,nprobe=None,rerank=None,threshold=None,offset=0,
+					 filters=None):
+		# search without fetching thumbnails, returning a list of (path,similarity) ordered by decreasing similarity
+		# (see SearchEngine.search for threshold and offset, getFilteredPaths for filters)
+		engine = self.getSearchEngine()
+		if self.query_projection:
+			embedding = self.query_projection.apply(embedding)
+		# an empty prefix and tag list do not restrict the search, so scan the whole matrix rather than a copy
+		filtered = filters and (filters.get("prefix") or filters.get("tags"))
+		rows = engine.getRows(self.getFilteredPaths(filters)) if filtered else None
+		return engine.search(embedding,firstN,mode=mode,nprobe=nprobe,rerank=rerank,threshold=threshold,offset=offset,
+							 rows=rows)
+
+	def benchmark(self,query_count=100,firstN=10,nprobe=None,rerank=None):
+		# measure the recall and latency of each search mode (see search_benchmark)
+		return benchmark(self.getSearchEngine(),SearchEngine.MODES,query_count,firstN,nprobe,rerank)
+
+	def similaritySearch(self,embedding,firstN=3,progress_cb=None,mode=SearchEngine.MODE_EXACT,nprobe=None,rerank=None,
+						 threshold=None,offset=0,filters=None):
+		distances = self.rankedSearch(embedding,firstN,mode,nprobe,rerank,threshold,offset,filters)
+		if progress_cb:
+			progress_cb("Searched "+ str(len(self.engine)) + " images")
+		images = self.fetchImages([path for (path,_) in distances])
+		return list(map(lambda x:(x[0],x[1],images.get(x[0],None)),distances))
+
+	def batchSimilaritySearch(self,embeddings,firstN=3,memory_budget=256*1024*1024):
+		# exact search for each of a batch of embeddings, yields a list of (path,similarity) matches for each
+		engine = self.getSearchEngine()
+		if self.query_projection:
+			embeddings = self.query_projection.apply(embeddings)
+		return engine.searchBatch(embeddings,firstN,memory_budget)
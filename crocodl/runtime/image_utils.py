@@ -33,17 +33,27 @@ class ImageUtils(object):
 
     @staticmethod
     def encodeThumbnail(image,max_w=160):
+        return base64.b64encode(ImageUtils.encodeThumbnailBytes(image,max_w))
+
+    @staticmethod
+    def encodeThumbnailBytes(image,max_w=160):
         image_w = image.size[0]
         if image_w > max_w:
             image = ImageUtils.resizeImage(image,max_w)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
         buffered = BytesIO()
         image.save(buffered, format="JPEG")
-        return base64.b64encode(buffered.getvalue())
+        return buffered.getvalue()
 
     @staticmethod
     def decodeThumbnail(s):
         return Image.open(BytesIO(base64.b64decode(s)))
 
+    @staticmethod
+    def decodeThumbnailBytes(data):
+        return Image.open(BytesIO(data))
+
     @staticmethod
     def convertImage(image,color_mode="rgb",target_size=None):
         if color_mode == 'grayscale':
@@ -0,0 +1,72 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import math
+import numpy as np
+
+from crocodl.runtime.kmeans import kmeans, nearest_centroids
+from crocodl.runtime.vector_index import VectorIndex
+
+class IVFIndex(VectorIndex):
+	"""
+	An inverted file index.  Rows are assigned to the nearest of nlist k-means centroids and a search
+	only scores the rows in the nprobe lists whose centroids are closest to the query.
+	"""
+
+	SUFFIX = ".ivf.npz"
+	MODEL_ARRAYS = ["centroids"]
+	CODE_DTYPE = np.int32
+
+	DEFAULT_NPROBE = 8
+
+	def __init__(self,db_path):
+		super(IVFIndex,self).__init__(db_path)
+		self.lists = None
+
+	@staticmethod
+	def defaultListCount(rows):
+		# roughly 4*sqrt(N) lists, keeping enough rows per list to train a centroid
+		return max(1,min(int(4*math.sqrt(rows)),rows // 39))
+
+	def fit(self,matrix,nlist):
+		if not nlist:
+			nlist = IVFIndex.defaultListCount(len(matrix))
+		centroids = kmeans(matrix,nlist,sample_size=max(nlist*64,10000))
+		norms = np.linalg.norm(centroids,axis=1,keepdims=True)
+		norms[norms == 0] = 1.0
+		self.centroids = centroids / norms
+
+	def encode(self,matrix):
+		return nearest_centroids(matrix,self.centroids)
+
+	def modelChanged(self):
+		self.lists = None
+
+	def getLists(self):
+		# the inverted lists, as the row numbers sorted by list and the offset of each list's start
+		if self.lists is None:
+			order = np.argsort(self.codes,kind="stable")
+			offsets = np.concatenate([[0],np.cumsum(np.bincount(self.codes,minlength=len(self.centroids)))])
+			self.lists = (order,offsets)
+		return self.lists
+
+	def candidates(self,query,nprobe=DEFAULT_NPROBE):
+		# return the rows in the nprobe lists closest to the (normalized) query
+		(order,offsets) = self.getLists()
+		nprobe = min(nprobe,len(self.centroids))
+		probes = np.argpartition(-self.centroids.dot(query),nprobe-1)[:nprobe]
+		return np.concatenate([order[offsets[probe]:offsets[probe+1]] for probe in probes])
@@ -16,6 +16,7 @@
 #   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from tensorflow.keras.applications.mobilenet_v2 import MobileNetV2, preprocess_input
+import numpy as np
 from tensorflow.keras.models import Model
 from tensorflow.keras.layers import Flatten, Dense
 from tensorflow.keras.preprocessing.image import img_to_array
@@ -118,3 +119,8 @@ class MobilenetModelUtils(object):
         sc = self.score(embedding_model,prepared_image)
         return sc
 
+    # compute embeddings for a list of prepared images in a single forward pass, returns an N x D array
+    def getEmbeddings(self,embedding_model,prepared_images):
+        batch = np.concatenate(prepared_images)
+        return embedding_model.predict(batch,batch_size=len(prepared_images))
+
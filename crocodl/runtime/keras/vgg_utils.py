@@ -16,6 +16,7 @@
 #   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from tensorflow.keras.applications.vgg16 import VGG16, preprocess_input
+import numpy as np
 from tensorflow.keras.models import Model
 from tensorflow.keras.layers import Flatten, Dense
 from tensorflow.keras.preprocessing.image import img_to_array
@@ -94,3 +95,8 @@ class VGGModelUtils(object):
     def getEmbedding(self,embedding_model,prepared_image):
         return self.score(embedding_model,prepared_image)
 
+    # compute embeddings for a list of prepared images in a single forward pass, returns an N x D array
+    def getEmbeddings(self,embedding_model,prepared_images):
+        batch = np.concatenate(prepared_images)
+        return embedding_model.predict(batch,batch_size=len(prepared_images))
+
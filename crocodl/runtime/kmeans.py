@@ -0,0 +1,49 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+
+def nearest_centroids(data,centroids,chunk_size=4096):
+	# return the index of the closest (euclidean) centroid for each row of data, processing data in chunks
+	centroid_norms = (centroids**2).sum(axis=1)
+	labels = np.zeros((len(data),),dtype=np.int32)
+	for start in range(0,len(data),chunk_size):
+		chunk = np.asarray(data[start:start+chunk_size],dtype=np.float32)
+		distances = centroid_norms[None,:] - 2*chunk.dot(centroids.T)
+		labels[start:start+len(chunk)] = np.argmin(distances,axis=1)
+	return labels
+
+def kmeans(data,k,iterations=20,sample_size=None,seed=0):
+	# cluster the rows of data into (at most) k clusters, returning a k x D float32 array of centroids
+	rng = np.random.RandomState(seed)
+	if sample_size and len(data) > sample_size:
+		data = data[np.sort(rng.choice(len(data),sample_size,replace=False))]
+	data = np.asarray(data,dtype=np.float32)
+	k = min(k,len(data))
+	centroids = data[rng.choice(len(data),k,replace=False)].copy()
+	for iteration in range(iterations):
+		labels = nearest_centroids(data,centroids)
+		order = np.argsort(labels,kind="stable")
+		counts = np.bincount(labels,minlength=k)
+		populated = np.nonzero(counts)[0]
+		starts = np.concatenate([[0],np.cumsum(counts)[:-1]])[populated]
+		centroids[populated] = np.add.reduceat(data[order],starts,axis=0) / counts[populated][:,None]
+		# re-seed any empty clusters from randomly chosen rows
+		empty = np.nonzero(counts == 0)[0]
+		if len(empty):
+			centroids[empty] = data[rng.choice(len(data),len(empty),replace=False)]
+	return centroids
@@ -0,0 +1,121 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import os.path
+import json
+import time
+
+class LoadJournal(object):
+	"""
+	Record the progress of loading a folder of images into an image store, so that a load which is cancelled,
+	or whose process dies, can be resumed.
+
+	The journal (<db>.load.json) is rewritten after each batch is committed to the store, recording the folder,
+	the state of the load (STATE_RUNNING, STATE_CANCELLED or STATE_COMPLETE), the number of files processed and
+	loaded so far, the paths in the last committed batch and the files which could not be read.  Files committed
+	to the store are skipped when the load is resumed, as are failed files that have not changed since.
+
+	A load is cancelled by creating the file <db>.load.cancel, which the loader checks between batches.
+	"""
+
+	STATE_RUNNING = "running"
+	STATE_CANCELLED = "cancelled"
+	STATE_COMPLETE = "complete"
+
+	def __init__(self,db_path):
+		self.path = db_path + ".load.json"
+		self.cancel_path = db_path + ".load.cancel"
+		self.journal = None
+
+	def read(self):
+		# return the journal of the most recent load, or None
+		try:
+			with open(self.path,"r") as f:
+				return json.loads(f.read())
+		except (OSError,ValueError):
+			return None
+
+	def write(self):
+		self.journal["updated"] = time.time()
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path,"w") as f:
+			f.write(json.dumps(self.journal))
+		os.replace(tmp_path,self.path)
+
+	def isResumable(self,folder=None):
+		journal = self.read()
+		return journal is not None and journal["state"] != LoadJournal.STATE_COMPLETE and \
+			(folder is None or journal["folder"] == os.path.abspath(folder))
+
+	def begin(self,folder):
+		# start loading folder, continuing the journal of an unfinished load of the same folder
+		# returns the number of files processed by the earlier load if it is being resumed, otherwise None
+		resumed = self.isResumable(folder)
+		processed_count = None
+		if resumed:
+			self.journal = self.read()
+			# a resumed load examines every file again, skipping those already stored
+			processed_count = self.journal["processed_count"]
+			self.journal["processed_count"] = 0
+		else:
+			self.journal = {"folder":os.path.abspath(folder),"processed_count":0,"loaded_count":0,
+							"last_batch":[],"failed":{}}
+		self.journal["state"] = LoadJournal.STATE_RUNNING
+		self.write()
+		return processed_count
+
+	def isFailed(self,relpath,size,mtime):
+		# True if relpath could not be read by an earlier attempt and has not changed since
+		failed = self.journal["failed"].get(relpath,None)
+		return failed is not None and failed[0] == size and failed[1] == mtime
+
+	def recordFailure(self,relpath,size,mtime,error):
+		self.journal["failed"][relpath] = [size,mtime,error]
+
+	def recordBatch(self,relpaths,processed_count):
+		# record a batch committed to the store, processed_count counts the files processed since the last batch
+		self.journal["processed_count"] += processed_count
+		if relpaths:
+			self.journal["loaded_count"] += len(relpaths)
+			self.journal["last_batch"] = relpaths
+		self.write()
+
+	def finish(self,state):
+		self.journal["state"] = state
+		self.write()
+		self.clearCancel()
+
+	def getCounts(self):
+		return (self.journal["processed_count"],self.journal["loaded_count"])
+
+	def cancel(self):
+		# ask a running load to stop, a batch being embedded or stored is completed first
+		with open(self.cancel_path,"w") as f:
+			f.write(str(time.time()))
+
+	def isCancelled(self):
+		return os.path.exists(self.cancel_path)
+
+	def clearCancel(self):
+		if os.path.exists(self.cancel_path):
+			os.unlink(self.cancel_path)
+
+	def remove(self):
+		for path in [self.path,self.cancel_path]:
+			if os.path.exists(path):
+				os.unlink(path)
@@ -0,0 +1,80 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+
+from crocodl.runtime.kmeans import kmeans, nearest_centroids
+from crocodl.runtime.vector_index import VectorIndex
+
+class PQIndex(VectorIndex):
+	"""
+	A product quantizer.  Each embedding is split into m sub-vectors and each sub-vector is replaced by the
+	(uint8) index of the nearest of 256 centroids trained for that subspace, so that a 4096 dimension
+	float32 embedding is held in m bytes.  Searches score the codes using per-query lookup tables
+	(asymmetric distance computation) and may exactly re-rank the best candidates using the full vectors.
+	"""
+
+	SUFFIX = ".pq.npz"
+	MODEL_ARRAYS = ["codebooks"]
+	CODE_DTYPE = np.uint8
+
+	CENTROIDS = 256
+
+	# by default, quantize each run of 16 dimensions (float32) into one byte, a 64x reduction
+	DIMENSIONS_PER_CODE = 16
+
+	DEFAULT_RERANK = 100
+
+	def getSubspaceCount(self):
+		return self.codebooks.shape[0]
+
+	def split(self,matrix):
+		# pad matrix with zero columns to a multiple of the subspace count and reshape to N x m x dsub
+		(m,_,dsub) = self.codebooks.shape
+		padded = np.zeros((len(matrix),m*dsub),dtype=np.float32)
+		padded[:,:matrix.shape[1]] = matrix
+		return padded.reshape(len(matrix),m,dsub)
+
+	def fit(self,matrix,m):
+		dimension = matrix.shape[1]
+		if not m:
+			m = max(1,dimension // PQIndex.DIMENSIONS_PER_CODE)
+		m = min(m,dimension)
+		dsub = -(-dimension // m)
+		sample = np.asarray(matrix[np.sort(np.random.RandomState(0).choice(len(matrix),min(len(matrix),PQIndex.CENTROIDS*40),replace=False))],dtype=np.float32)
+		self.codebooks = np.zeros((m,PQIndex.CENTROIDS,dsub),dtype=np.float32)
+		subvectors = self.split(sample)
+		for subspace in range(m):
+			centroids = kmeans(subvectors[:,subspace,:],PQIndex.CENTROIDS,iterations=15,seed=subspace)
+			self.codebooks[subspace,:len(centroids),:] = centroids
+
+	def encode(self,matrix):
+		subvectors = self.split(matrix)
+		codes = np.zeros((len(matrix),self.getSubspaceCount()),dtype=np.uint8)
+		for subspace in range(self.getSubspaceCount()):
+			codes[:,subspace] = nearest_centroids(subvectors[:,subspace,:],self.codebooks[subspace])
+		return codes
+
+	def score(self,query,rows=None,chunk_size=65536):
+		# approximate the inner product between the query and each row (or the given rows) from the codes
+		tables = np.einsum("mkd,md->mk",self.codebooks,self.split(query[None,:])[0])
+		codes = self.codes if rows is None else self.codes[rows]
+		subspaces = np.arange(self.getSubspaceCount())[None,:]
+		scores = np.zeros((len(codes),),dtype=np.float32)
+		for start in range(0,len(codes),chunk_size):
+			scores[start:start+chunk_size] = tables[subspaces,codes[start:start+chunk_size]].sum(axis=1)
+		return scores
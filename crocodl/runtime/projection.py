@@ -0,0 +1,62 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+
+class Projection(object):
+	"""
+	An affine projection y = W.x + b applied to embeddings, for example to reduce their dimension using PCA
+	"""
+
+	def __init__(self,weights,bias):
+		self.weights = np.asarray(weights,dtype=np.float32)
+		self.bias = np.asarray(bias,dtype=np.float32)
+
+	def getInputDimension(self):
+		return self.weights.shape[1]
+
+	def getOutputDimension(self):
+		return self.weights.shape[0]
+
+	def apply(self,embeddings):
+		# project a single embedding (returning a vector) or the rows of a matrix (returning a matrix)
+		embeddings = np.asarray(embeddings,dtype=np.float32)
+		if embeddings.shape[-1] != self.getInputDimension():
+			raise Exception("Embedding dimension %d does not match projection input dimension %d"%(embeddings.shape[-1],self.getInputDimension()))
+		return embeddings.dot(self.weights.T) + self.bias
+
+	def then(self,projection):
+		# return the projection equivalent to applying this projection followed by another
+		return Projection(projection.weights.dot(self.weights),projection.weights.dot(self.bias)+projection.bias)
+
+	@staticmethod
+	def fitPCA(matrix,dimension,whiten=False,sample_size=20000,seed=0):
+		# fit a projection onto the first dimension principal components of the rows of matrix,
+		# optionally scaling each component to unit variance (whitening)
+		if sample_size and len(matrix) > sample_size:
+			matrix = matrix[np.sort(np.random.RandomState(seed).choice(len(matrix),sample_size,replace=False))]
+		matrix = np.asarray(matrix,dtype=np.float64)
+		dimension = min(dimension,matrix.shape[1])
+		mean = matrix.mean(axis=0)
+		centered = matrix - mean
+		covariance = centered.T.dot(centered) / max(1,len(matrix)-1)
+		(eigenvalues,eigenvectors) = np.linalg.eigh(covariance)
+		order = np.argsort(eigenvalues)[::-1][:dimension]
+		weights = eigenvectors[:,order].T
+		if whiten:
+			weights = weights / np.sqrt(np.maximum(eigenvalues[order],1e-12))[:,None]
+		return Projection(weights,-weights.dot(mean))
@@ -0,0 +1,72 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from crocodl.runtime.search_engine import SearchEngine
+
+class ResultCache(object):
+	"""
+	A bounded LRU cache of search results, keyed by the store generation, the query embedding (normalized and
+	quantized so that near-identical queries share an entry) and the other search parameters.
+
+	The cache is emptied whenever the store generation changes, as all its results may then be out of date.
+	"""
+
+	# each component of the normalized query is rounded to a multiple of 1/QUANTIZATION
+	QUANTIZATION = 127
+
+	def __init__(self,max_entries=1000):
+		self.max_entries = max_entries
+		self.entries = OrderedDict()
+		self.generation = None
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def makeKey(embedding,*parameters):
+		query = np.rint(SearchEngine.normalizeQuery(embedding)*ResultCache.QUANTIZATION).astype(np.int8)
+		return (query.tobytes(),repr(parameters))
+
+	def get(self,generation,key):
+		with self.lock:
+			if generation != self.generation:
+				self.entries.clear()
+				self.generation = generation
+			result = self.entries.get(key,None)
+			if result is None:
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return result
+
+	def put(self,generation,key,result):
+		with self.lock:
+			if generation != self.generation or self.max_entries <= 0:
+				return
+			self.entries[key] = result
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+	def getStats(self):
+		with self.lock:
+			return {"hits":self.hits,"misses":self.misses,"entries":len(self.entries)}
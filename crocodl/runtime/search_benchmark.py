@@ -0,0 +1,46 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import time
+import numpy as np
+
+from crocodl.runtime.search_engine import SearchEngine
+
+def benchmark(engine,modes,query_count=100,firstN=10,nprobe=None,rerank=None,seed=0):
+	# measure the recall (the fraction of the exact top firstN results found) and the latency of each search
+	# mode, using a sample of the stored vectors as queries
+	# returns a dict mapping each mode to its recall and mean and 95th percentile latencies in milliseconds,
+	# with index_available False if the mode's index is not trained (searches fall back to an exact search)
+	if len(engine) == 0:
+		return {}
+	rows = np.sort(np.random.RandomState(seed).choice(len(engine),min(query_count,len(engine)),replace=False))
+	queries = np.asarray(engine.matrix[rows],dtype=np.float32)
+	expected = [set(path for (path,_) in engine.search(query,firstN)) for query in queries]
+	results = {}
+	for mode in modes:
+		latencies = []
+		found = 0
+		for (query,exact_paths) in zip(queries,expected):
+			start = time.perf_counter()
+			matches = engine.search(query,firstN,mode=mode,nprobe=nprobe,rerank=rerank)
+			latencies.append((time.perf_counter()-start)*1000)
+			found += len(exact_paths.intersection(path for (path,_) in matches))
+		results[mode] = {"recall":found / max(1,sum(len(paths) for paths in expected)),
+						 "mean_latency_ms":float(np.mean(latencies)),
+						 "p95_latency_ms":float(np.percentile(latencies,95)),
+						 "index_available":mode == SearchEngine.MODE_EXACT or mode in engine.indexes}
+	return results
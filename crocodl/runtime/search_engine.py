@@ -0,0 +1,184 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+
+class SearchEngine(object):
+
+	MODE_EXACT = "exact"
+	MODE_IVF = "ivf"
+	MODE_PQ = "pq"
+	MODE_BINARY = "binary"
+	MODE_COARSE = "coarse"
+
+	MODES = [MODE_EXACT,MODE_IVF,MODE_PQ,MODE_BINARY,MODE_COARSE]
+
+	# when the matrix is stored at reduced precision, the number of candidates re-ranked using the exact vectors
+	# and the allowance for quantization error when selecting candidates for a threshold search
+	COMPACT_RERANK = 100
+	COMPACT_MARGIN = 0.02
+
+	def __init__(self,paths,matrix,normalized=False,indexes=None,exact_vectors=None):
+		# paths[i] is the image path for row i of the embedding matrix
+		# if normalized is True the rows of matrix are already unit length and matrix is used as-is
+		# indexes maps a search mode to an index (see VectorIndex) that is up to date with matrix
+		# if matrix is stored at reduced precision (see CompactMatrix), exact_vectors should be a function
+		# returning the full precision (normalized) vectors for a list of paths, used to re-rank the best candidates
+		self.paths = paths
+		self.matrix = matrix if normalized else SearchEngine.normalize(matrix)
+		self.indexes = indexes or {}
+		self.exact_vectors = exact_vectors
+		self.rows_by_path = None
+
+	def __len__(self):
+		return len(self.paths)
+
+	@staticmethod
+	def normalize(matrix):
+		# scale each row of matrix to unit length, returning a contiguous float32 array
+		# (float32 arrays are normalized in place)
+		matrix = np.require(np.atleast_2d(np.asarray(matrix,dtype=np.float32)),requirements=["C","W"])
+		norms = np.linalg.norm(matrix,axis=1,keepdims=True)
+		norms[norms == 0] = 1.0
+		matrix /= norms
+		return matrix
+
+	@staticmethod
+	def normalizeQuery(embedding):
+		return SearchEngine.normalize(np.array(embedding,dtype=np.float32))[0]
+
+	@staticmethod
+	def topN(scores,firstN):
+		# return the indices of the firstN highest scores, in descending score order
+		n = min(firstN,len(scores))
+		if n <= 0:
+			return np.zeros((0,),dtype=np.int64)
+		if n < len(scores):
+			indices = np.argpartition(-scores,n-1)[:n]
+		else:
+			indices = np.arange(len(scores))
+		return indices[np.argsort(-scores[indices],kind="stable")]
+
+	def score(self,embedding):
+		# compute the cosine similarity between embedding and every row
+		return self.matrix.dot(SearchEngine.normalizeQuery(embedding))
+
+	@staticmethod
+	def select(rows,scores,limit,threshold=None):
+		# order rows by decreasing score, keeping those with score >= threshold (if specified) and then the best
+		# limit rows (all rows if limit is None), returns arrays of the selected rows and their scores
+		if threshold is not None:
+			keep = np.nonzero(scores >= threshold)[0]
+			(rows,scores) = (rows[keep],scores[keep])
+		order = SearchEngine.topN(scores,len(scores) if limit is None else limit)
+		return (rows[order],scores[order])
+
+	def rank(self,query,rows,limit,threshold=None):
+		# score only the given rows exactly against the normalized query and select the best
+		if self.exact_vectors is not None:
+			vectors = self.exact_vectors([self.paths[row] for row in rows])
+		else:
+			vectors = self.matrix[rows]
+		return SearchEngine.select(rows,vectors.dot(query),limit,threshold)
+
+	def scan(self,query,rows,limit,threshold=None):
+		# score the given rows (all rows if rows is None) using the matrix and select the best, if the matrix is
+		# stored at reduced precision the best candidates are then re-ranked exactly
+		if rows is None:
+			(rows,scores) = (np.arange(len(self.paths)),self.matrix.dot(query))
+		else:
+			scores = self.matrix[rows].dot(query)
+		if self.exact_vectors is None:
+			return SearchEngine.select(rows,scores,limit,threshold)
+		if threshold is not None:
+			keep = np.nonzero(scores >= threshold - SearchEngine.COMPACT_MARGIN)[0]
+			(rows,scores) = (rows[keep],scores[keep])
+		if limit is not None:
+			rows = rows[SearchEngine.topN(scores,max(limit,SearchEngine.COMPACT_RERANK))]
+		return self.rank(query,np.sort(rows),limit,threshold)
+
+	def rerankCandidates(self,query,rows,approximate_scores,limit,rerank,threshold=None):
+		# take the best rerank rows (at least limit) by approximate score, then rank those exactly using the full vectors
+		if not rerank:
+			return SearchEngine.select(rows,approximate_scores,limit,threshold)
+		candidates = rows[SearchEngine.topN(approximate_scores,max(limit or 0,rerank))]
+		return self.rank(query,np.sort(candidates),limit,threshold)
+
+	def getRows(self,paths):
+		# return a sorted array of the rows holding the given paths, ignoring paths which are not in the matrix
+		if self.rows_by_path is None:
+			self.rows_by_path = {path:row for (row,path) in enumerate(self.paths)}
+		rows = [self.rows_by_path[path] for path in paths if path in self.rows_by_path]
+		return np.unique(np.array(rows,dtype=np.int64))
+
+	def search(self,embedding,firstN=3,mode=MODE_EXACT,nprobe=None,rerank=None,threshold=None,offset=0,rows=None):
+		# search using the given mode, falling back to an exact search if the index for that mode is not available
+		#   nprobe - the number of lists to scan (ivf)
+		#   rerank - the number of approximate candidates to re-rank exactly, 0 to return approximate scores
+		#            (pq, binary, coarse)
+		# returns the matches ranked offset to offset+firstN (all matches from offset if firstN is None), only
+		# including matches with similarity >= threshold if a threshold is specified
+		# if a sorted array of rows is specified, only those rows are searched
+		if len(self.paths) == 0 or (rows is not None and len(rows) == 0):
+			return []
+		limit = None if firstN is None else offset+firstN
+		query = SearchEngine.normalizeQuery(embedding)
+		index = self.indexes.get(mode,None)
+		if mode == SearchEngine.MODE_IVF and index is not None:
+			candidates = np.sort(index.candidates(query,nprobe or index.DEFAULT_NPROBE))
+			if rows is not None:
+				# scanning the rows exactly is cheaper than scanning the candidate lists when there are fewer rows
+				candidates = rows if len(rows) <= len(candidates) else np.intersect1d(candidates,rows,assume_unique=True)
+			(rows,scores) = self.scan(query,candidates,limit,threshold)
+		elif mode in (SearchEngine.MODE_PQ,SearchEngine.MODE_BINARY,SearchEngine.MODE_COARSE) and index is not None:
+			if rerank is None:
+				rerank = index.DEFAULT_RERANK
+			if rows is None:
+				rows = np.arange(len(self.paths))
+				approximate_scores = index.score(query)
+			else:
+				approximate_scores = index.score(query,rows)
+			(rows,scores) = self.rerankCandidates(query,rows,approximate_scores,limit,rerank,threshold)
+		else:
+			(rows,scores) = self.scan(query,rows,limit,threshold)
+		return [(self.paths[row],float(score)) for (row,score) in zip(rows[offset:],scores[offset:])]
+
+	def searchBatch(self,embeddings,firstN=3,memory_budget=256*1024*1024):
+		# exact search for each row of embeddings, scoring chunks of queries against the whole matrix in a single
+		# matrix product, with the chunk size limited so that each chunk's scores fit within memory_budget bytes
+		# yields a list of (path,score) matches for each query, in order
+		# (if the matrix is stored at reduced precision the scores are approximate)
+		queries = SearchEngine.normalize(np.array(embeddings,dtype=np.float32))
+		chunk_size = max(1,memory_budget // max(1,4*len(self.paths)))
+		n = min(firstN,len(self.paths))
+		for start in range(0,len(queries),chunk_size):
+			chunk = queries[start:start+chunk_size]
+			if n <= 0:
+				for _ in range(len(chunk)):
+					yield []
+				continue
+			scores = self.matrix.dot(chunk.T).T
+			if n < len(self.paths):
+				best = np.argpartition(-scores,n-1,axis=1)[:,:n]
+			else:
+				best = np.tile(np.arange(len(self.paths)),(len(chunk),1))
+			best_scores = np.take_along_axis(scores,best,axis=1)
+			order = np.argsort(-best_scores,axis=1,kind="stable")
+			best = np.take_along_axis(best,order,axis=1)
+			best_scores = np.take_along_axis(best_scores,order,axis=1)
+			for (rows,row_scores) in zip(best,best_scores):
+				yield [(self.paths[row],float(score)) for (row,score) in zip(rows,row_scores)]
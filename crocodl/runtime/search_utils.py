@@ -0,0 +1,80 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from threading import Thread
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+import json
+import time
+
+class SearchHandler(BaseHTTPRequestHandler):
+    def _set_response(self,code=200):
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+
+    def do_GET(self):
+        SearchServer.last_request = time.time()
+        url = urlparse(self.path)
+        params = {k:v[0] for (k,v) in parse_qs(url.query,keep_blank_values=True).items()}
+        try:
+            if url.path == "/search":
+                # an empty top_n requests all matches above the threshold
+                top_n = int(params.get("top_n",3)) if params.get("top_n",3) != "" else None
+                threshold = float(params["threshold"]) if params.get("threshold","") else None
+                filters = {"prefix":params.get("prefix",""),
+                           "tags":[tag for tag in params.get("tags","").split(",") if tag]}
+                if not filters["prefix"] and not filters["tags"]:
+                    filters = None
+                result = SearchServer.searcher.search(params["image_path"],top_n,int(params.get("offset",0)),threshold,filters)
+            elif url.path == "/status":
+                result = {"status":"ready"}
+            else:
+                self._set_response(404)
+                return
+        except Exception as ex:
+            self._set_response(500)
+            self.wfile.write(json.dumps({"error":str(ex)}).encode('utf-8'))
+            return
+        self._set_response()
+        self.wfile.write(json.dumps(result).encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+class SearchServer(Thread):
+    """
+    Serve searches from a long lived process which keeps the embedding model and image store loaded.
+    The server exits once no requests have been received for idle_timeout seconds.
+    """
+
+    searcher = None
+    last_request = 0
+
+    def __init__(self,port,searcher,idle_timeout=600):
+        super().__init__(daemon=False)
+        SearchServer.searcher = searcher
+        SearchServer.last_request = time.time()
+        self.port = port
+        self.idle_timeout = idle_timeout
+
+    def run(self):
+        httpd = HTTPServer(('localhost', self.port), SearchHandler)
+        httpd.timeout = 1
+        while time.time() - SearchServer.last_request < self.idle_timeout:
+            httpd.handle_request()
+        httpd.server_close()
@@ -0,0 +1,286 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import os.path
+import json
+import heapq
+import hashlib
+import itertools
+import concurrent.futures
+import numpy as np
+from crocodl.runtime.image_store import ImageStore
+from crocodl.runtime.load_journal import LoadJournal
+from crocodl.runtime.search_engine import SearchEngine
+from crocodl.runtime.projection import Projection
+from crocodl.runtime.duplicate_finder import find_duplicate_groups, METHOD_AUTO
+
+def searchShard(shard,embedding,firstN,mode,nprobe,rerank,threshold,filters):
+	return shard.rankedSearch(embedding,firstN,mode,nprobe,rerank,threshold,0,filters)
+
+def batchSearchShard(shard,embeddings,firstN,memory_budget):
+	return list(shard.batchSimilaritySearch(embeddings,firstN,memory_budget))
+
+class ShardedImageStore(object):
+	"""
+	An image store split across several ImageStore shard databases, listed in a JSON manifest stored at path.
+	Each image is stored in the shard selected by a hash of its path, searches are run on all shards in
+	parallel by a pool of worker threads and the per-shard results merged.  Threads rather than processes are
+	used as the search service runs alongside tensorflow and its own threads, which are not safe to fork, and
+	the matrix products that dominate a search release the GIL.
+
+	Use ShardedImageStore.openStore and ShardedImageStore.deleteStore to work with either kind of store.
+	"""
+
+	MANIFEST_FORMAT = "crocodl-sharded-image-store"
+
+	def __init__(self,path,shard_count=None):
+		self.path = path
+		if os.path.exists(path):
+			with open(path) as f:
+				manifest = json.loads(f.read())
+			shard_names = manifest["shards"]
+		else:
+			base = os.path.splitext(os.path.split(path)[1])[0]
+			shard_names = ["%s.shard%03d.db"%(base,idx) for idx in range(shard_count)]
+			with open(path,"w") as f:
+				f.write(json.dumps({"format":ShardedImageStore.MANIFEST_FORMAT,"shards":shard_names}))
+		folder = os.path.split(path)[0]
+		self.shard_paths = [os.path.join(folder,name) for name in shard_names]
+		self.shards = [ImageStore(shard_path) for shard_path in self.shard_paths]
+		self.executor = None
+
+	@staticmethod
+	def isSharded(path):
+		# sharded stores are identified by their manifest, a JSON file rather than an SQLite database
+		if not os.path.isfile(path):
+			return False
+		with open(path,"rb") as f:
+			header = f.read(1024)
+		try:
+			return json.loads(header.decode("utf-8")).get("format") == ShardedImageStore.MANIFEST_FORMAT
+		except ValueError:
+			return False
+
+	@staticmethod
+	def openStore(path,shard_count=1):
+		# open the image store at path, if no store exists a sharded store is created when shard_count > 1
+		if ShardedImageStore.isSharded(path) or (not os.path.exists(path) and shard_count > 1):
+			return ShardedImageStore(path,shard_count)
+		return ImageStore(path)
+
+	@staticmethod
+	def deleteStore(path):
+		if ShardedImageStore.isSharded(path):
+			store = ShardedImageStore(path)
+			store.shutdown()
+			for shard_path in store.shard_paths:
+				ImageStore.delete(shard_path)
+			os.unlink(path)
+			LoadJournal(path).remove()
+		else:
+			ImageStore.delete(path)
+
+	def getShard(self,path):
+		digest = hashlib.md5(path.encode("utf-8")).hexdigest()
+		return self.shards[int(digest[:8],16) % len(self.shards)]
+
+	def groupByShard(self,items,key=lambda item:item):
+		groups = {}
+		for item in items:
+			groups.setdefault(id(self.getShard(key(item))),[]).append(item)
+		return [(shard,groups[id(shard)]) for shard in self.shards if id(shard) in groups]
+
+	def getExecutor(self):
+		if self.executor is None:
+			workers = min(len(self.shards),os.cpu_count() or 1)
+			self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+		return self.executor
+
+	def shutdown(self):
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
+
+	def __len__(self):
+		return sum(len(shard) for shard in self.shards)
+
+	def isEmpty(self):
+		return len(self) == 0
+
+	def clear(self):
+		for shard in self.shards:
+			shard.clear()
+
+	def getGeneration(self):
+		# every change to a shard increments its generation, so the sum identifies the version of the whole store
+		return sum(shard.getGeneration() for shard in self.shards)
+
+	def setArchitecture(self,architecture,precision=None):
+		for shard in self.shards:
+			shard.setArchitecture(architecture,precision)
+
+	def getPrecision(self):
+		return self.shards[0].getPrecision()
+
+	def setPrecision(self,precision):
+		for shard in self.shards:
+			shard.setPrecision(precision)
+
+	def getArchitecture(self):
+		return self.shards[0].getArchitecture()
+
+	def setIndexes(self,indexes):
+		for shard in self.shards:
+			shard.setIndexes(indexes)
+
+	def getIndexes(self):
+		return self.shards[0].getIndexes()
+
+	def open(self):
+		for shard in self.shards:
+			shard.open()
+
+	def syncSidecar(self):
+		for shard in self.shards:
+			shard.syncSidecar()
+
+	def addEmbedding(self,path,embedding,image):
+		self.getShard(path).addEmbedding(path,embedding,image)
+
+	def addEmbeddings(self,embeddings):
+		for (shard,entries) in self.groupByShard(embeddings,lambda entry:entry[0]):
+			shard.addEmbeddings(entries)
+
+	def commit(self):
+		for shard in self.shards:
+			shard.commit()
+
+	def getProjection(self):
+		return self.shards[0].getProjection()
+
+	def fitProjection(self,dimension,whiten=False):
+		# fit a single projection to the embeddings of all shards so that their similarities remain comparable
+		(_,matrix) = self.loadEmbeddings(original=True)
+		if not len(matrix):
+			raise Exception("Cannot fit a projection to an empty image store")
+		pca = Projection.fitPCA(matrix,dimension,whiten)
+		projection = None
+		for shard in self.shards:
+			projection = shard.applyProjection(pca)
+		return projection
+
+	def getFileInfo(self):
+		file_info = {}
+		for shard in self.shards:
+			file_info.update(shard.getFileInfo())
+		return file_info
+
+	def updateFileInfo(self,file_infos):
+		for (shard,entries) in self.groupByShard(file_infos,lambda entry:entry[0]):
+			shard.updateFileInfo(entries)
+
+	def findDuplicates(self,threshold=0.95,method=METHOD_AUTO,tables=8,bucket_size=1000,progress_cb=None):
+		# duplicates are found across all shards, each shard records the groups containing its images
+		(paths,matrix) = self.loadEmbeddings()
+		groups = find_duplicate_groups(matrix,threshold,method,tables,bucket_size,progress_cb)
+		groups = [sorted(paths[row] for row in group) for group in groups]
+		for shard in self.shards:
+			shard_groups = [(group_id,[path for path in group if self.getShard(path) is shard])
+							for (group_id,group) in enumerate(groups)]
+			shard_groups = [(group_id,group) for (group_id,group) in shard_groups if group]
+			shard.setDuplicates([group for (_,group) in shard_groups],threshold,
+								[group_id for (group_id,_) in shard_groups])
+		return groups
+
+	def getDuplicates(self):
+		groups = {}
+		for shard in self.shards:
+			for (group_id,paths) in shard.getDuplicates().items():
+				groups.setdefault(group_id,[]).extend(paths)
+		return {group_id:sorted(paths) for (group_id,paths) in groups.items()}
+
+	def setTags(self,path_tags):
+		for (shard,entries) in self.groupByShard(path_tags,lambda entry:entry[0]):
+			shard.setTags(entries)
+
+	def getTags(self,path):
+		return self.getShard(path).getTags(path)
+
+	def close(self):
+		for shard in self.shards:
+			shard.close()
+
+	def checkpoint(self):
+		for shard in self.shards:
+			shard.checkpoint()
+
+	def fetchImage(self,path):
+		return self.getShard(path).fetchImage(path)
+
+	def fetchImages(self,paths):
+		images = {}
+		for (shard,shard_paths) in self.groupByShard(paths):
+			images.update(shard.fetchImages(shard_paths))
+		return images
+
+	def loadEmbeddings(self,original=False):
+		paths = []
+		matrices = []
+		for shard in self.shards:
+			(shard_paths,matrix) = shard.loadEmbeddings(original)
+			if len(shard_paths):
+				paths += shard_paths
+				matrices.append(matrix)
+		if not matrices:
+			return paths, np.zeros((0,0),dtype=np.float32)
+		return paths, np.concatenate(matrices)
+
+	def rankedSearch(self,embedding,firstN=3,mode=SearchEngine.MODE_EXACT,nprobe=None,rerank=None,threshold=None,offset=0,
+					 filters=None):
+		# each shard returns its best offset+firstN matches, the best of those are then merged
+		embedding = np.asarray(embedding,dtype=np.float32)
+		limit = None if firstN is None else offset+firstN
+		futures = [self.getExecutor().submit(searchShard,shard,embedding,limit,mode,nprobe,rerank,threshold,filters)
+				   for shard in self.shards]
+		results = itertools.chain.from_iterable(future.result() for future in futures)
+		if limit is None:
+			return sorted(results,key=lambda match:-match[1])[offset:]
+		return heapq.nlargest(limit,results,key=lambda match:match[1])[offset:]
+
+	def benchmark(self,query_count=100,firstN=10,nprobe=None,rerank=None):
+		# the shards are searched in parallel, so benchmark the search of a single shard
+		return self.shards[0].benchmark(query_count,firstN,nprobe,rerank)
+
+	def similaritySearch(self,embedding,firstN=3,progress_cb=None,mode=SearchEngine.MODE_EXACT,nprobe=None,rerank=None,
+						 threshold=None,offset=0,filters=None):
+		distances = self.rankedSearch(embedding,firstN,mode,nprobe,rerank,threshold,offset,filters)
+		if progress_cb:
+			progress_cb("Searched "+ str(len(self)) + " images")
+		images = self.fetchImages([path for (path,_) in distances])
+		return list(map(lambda x:(x[0],x[1],images.get(x[0],None)),distances))
+
+	def batchSimilaritySearch(self,embeddings,firstN=3,memory_budget=256*1024*1024):
+		# each shard searches the whole batch using its share of the memory budget, the results for each query
+		# are then merged
+		embeddings = np.asarray(embeddings,dtype=np.float32)
+		shard_budget = memory_budget // len(self.shards)
+		futures = [self.getExecutor().submit(batchSearchShard,shard,embeddings,firstN,shard_budget)
+				   for shard in self.shards]
+		shard_results = [future.result() for future in futures]
+		for query_results in zip(*shard_results):
+			yield heapq.nlargest(firstN,itertools.chain.from_iterable(query_results),key=lambda match:match[1])
@@ -0,0 +1,173 @@
+#    Copyright (C) 2020 crocoDL developers
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+#   and associated documentation files (the "Software"), to deal in the Software without
+#   restriction, including without limitation the rights to use, copy, modify, merge, publish,
+#   distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or
+#   substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+#   BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#   NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#   DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import os.path
+import json
+import numpy as np
+
+class VectorIndex(object):
+	"""
+	Base class for indexes built over the rows of an image store's (normalized) embedding matrix.
+
+	Subclasses learn a model from the matrix (fit) and compute a fixed size code for each row (encode).
+	The index is persisted in three files:
+		<db><SUFFIX>       - the model arrays (named in MODEL_ARRAYS), written when the model is trained
+		<db><SUFFIX>.codes - the raw codes, one fixed size row per embedding, memory mapped when loaded
+		<db><SUFFIX>.json  - a header recording the number of rows, the shape of each row's code and the store
+		                     id and generation that the codes reflect
+	Updates write only the new and modified rows of the codes file, so that their cost does not grow with the
+	size of the store.
+	"""
+
+	SUFFIX = None
+	MODEL_ARRAYS = []
+	CODE_DTYPE = np.int32
+
+	# do not train until the store holds this many images
+	MIN_TRAINING_ROWS = 1000
+
+	# retrain once the store has grown by this factor since the model was fitted
+	RETRAIN_GROWTH = 4
+
+	def __init__(self,db_path):
+		self.path = db_path + self.SUFFIX
+		self.codes_path = self.path + ".codes"
+		self.header_path = self.path + ".json"
+		self.clearModel()
+
+	def clearModel(self):
+		for name in self.MODEL_ARRAYS:
+			setattr(self,name,None)
+		self.codes = None
+		self.code_shape = None
+		self.store_id = None
+		self.generation = None
+		self.trained_rows = 0
+
+	def remove(self):
+		for path in [self.path,self.codes_path,self.header_path]:
+			if os.path.exists(path):
+				os.unlink(path)
+		self.clearModel()
+		self.modelChanged()
+
+	def isTrained(self):
+		return getattr(self,self.MODEL_ARRAYS[0]) is not None
+
+	def load(self):
+		if not os.path.exists(self.path):
+			return False
+		try:
+			with np.load(self.path) as f:
+				for name in self.MODEL_ARRAYS:
+					setattr(self,name,f[name])
+				self.trained_rows = int(f["trained_rows"])
+			with open(self.header_path,"r") as f:
+				header = json.loads(f.read())
+			self.store_id = header["store_id"]
+			self.generation = header["generation"]
+			self.code_shape = tuple(header["shape"])
+			self.mapCodes(header["count"])
+		except (OSError,ValueError,KeyError):
+			self.remove()
+			return False
+		self.modelChanged()
+		return True
+
+	def mapCodes(self,count):
+		if count == 0:
+			self.codes = np.zeros((0,)+self.code_shape,dtype=self.CODE_DTYPE)
+		else:
+			self.codes = np.memmap(self.codes_path,dtype=self.CODE_DTYPE,mode="r",shape=(count,)+self.code_shape)
+
+	def saveModel(self):
+		tmp_path = self.path + ".tmp.npz"
+		arrays = {name:getattr(self,name) for name in self.MODEL_ARRAYS}
+		np.savez(tmp_path,trained_rows=self.trained_rows,**arrays)
+		os.replace(tmp_path,self.path)
+
+	def writeHeader(self,count):
+		tmp_path = self.header_path + ".tmp"
+		with open(tmp_path,"w") as f:
+			f.write(json.dumps({"store_id":self.store_id,"generation":self.generation,"count":count,
+								"shape":list(self.code_shape)}))
+		os.replace(tmp_path,self.header_path)
+
+	def isCurrent(self,store_id,generation):
+		return self.isTrained() and self.store_id == store_id and self.generation == generation
+
+	def needsTraining(self,rows):
+		if rows < self.MIN_TRAINING_ROWS:
+			return False
+		return not self.isTrained() or rows >= self.trained_rows * self.RETRAIN_GROWTH
+
+	def train(self,matrix,store_id,generation,setting=None):
+		self.fit(matrix,setting)
+		self.trained_rows = len(matrix)
+		self.saveModel()
+		self.reassign(matrix,store_id,generation)
+
+	def encodeRows(self,matrix,chunk_size=4096):
+		codes = []
+		for start in range(0,len(matrix),chunk_size):
+			codes.append(self.encode(np.asarray(matrix[start:start+chunk_size],dtype=np.float32)))
+		if not codes:
+			return self.encode(np.zeros((0,matrix.shape[1]),dtype=np.float32))
+		return np.concatenate(codes)
+
+	def reassign(self,matrix,store_id,generation):
+		# recompute the codes for every row, replacing the codes file so that existing readers keep their mappings
+		codes = np.ascontiguousarray(self.encodeRows(matrix),dtype=self.CODE_DTYPE)
+		with open(self.codes_path + ".tmp","wb") as f:
+			f.write(codes.tobytes())
+		os.replace(self.codes_path + ".tmp",self.codes_path)
+		self.code_shape = codes.shape[1:]
+		self.store_id = store_id
+		self.generation = generation
+		self.writeHeader(len(codes))
+		self.mapCodes(len(codes))
+		self.modelChanged()
+
+	def update(self,matrix,rows,store_id,generation):
+		# compute codes for the given (modified) rows of matrix and for any rows added since the last update,
+		# writing just those rows into the codes file
+		count = len(matrix)
+		previous_count = len(self.codes)
+		rows = np.union1d(np.asarray(rows,dtype=np.int64),np.arange(previous_count,count))
+		if len(rows):
+			codes = np.ascontiguousarray(self.encode(np.asarray(matrix[rows],dtype=np.float32)),dtype=self.CODE_DTYPE)
+			row_size = codes[0].nbytes
+			with open(self.codes_path,"r+b") as f:
+				for (row,code) in zip(rows,codes):
+					f.seek(int(row)*row_size)
+					f.write(code.tobytes())
+		self.store_id = store_id
+		self.generation = generation
+		self.writeHeader(count)
+		self.mapCodes(count)
+		self.modelChanged()
+
+	def modelChanged(self):
+		# called when the model or codes change, subclasses may override to discard cached data
+		pass
+
+	def fit(self,matrix,setting):
+		raise NotImplementedError()
+
+	def encode(self,matrix):
+		raise NotImplementedError()